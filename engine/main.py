@@ -65,6 +65,11 @@ opt.add_option('--xml', '-x',
                action='store_true', dest='xml', default=False,
                help='output the engines xml part, default: %default')
 
+opt.add_option('--migrate', '-m',
+               action='store_true', dest='migrate', default=False,
+               help='migrate the outdated user databases of the tables, '
+               'or of the one given by --table, and exit, default: %default')
+
 opt.add_option('--no-debug', '-n',
                action='store_false', dest='debug', default=True,
                help='redirect stdout and stderr to ~/.ibus/tables/debug.log, default: %default')
@@ -73,7 +78,7 @@ opt.add_option('--no-debug', '-n',
 #if not options.db:
 #    opt.error('no db found!')
 
-if (not options.xml) and options.debug:
+if not (options.xml or options.migrate) and options.debug:
     if not os.access(os.path.expanduser('~/.ibus/tables'), os.F_OK):
         os.system('mkdir -p ~/.ibus/tables')
 
@@ -234,9 +239,6 @@ def main():
 
         return 0
 
-    if options.daemon :
-        if os.fork():
-                sys.exit()
     if options.db:
         if os.access(options.db, os.F_OK):
             db = options.db
@@ -244,6 +246,29 @@ def main():
             db = '%s%s%s' % (db_dir,os.path.sep, os.path.basename(options.db) )
     else:
         db=""
+
+    if options.migrate:
+        # migrate the user databases now, so that the engines do not
+        # need to do it when they start, only those the user already has
+        if db:
+            dbs = [db]
+        else:
+            dbs = map(lambda x: os.path.join(db_dir, x),
+                      filter(lambda x: x.endswith('.db'), os.listdir(db_dir)))
+        tables_path = os.path.join(os.getenv('HOME'), '.ibus', 'tables')
+        for _db in dbs:
+            user_db = os.path.join(tables_path, os.path.basename(_db).replace(
+                '.db', '-user.db'))
+            if not os.path.exists(user_db):
+                continue
+            _sq_db = tabsqlitedb.tabsqlitedb(name=_db)
+            _sq_db.upgrade_user_db(user_db)
+            _sq_db.db.close()
+        return 0
+
+    if options.daemon :
+        if os.fork():
+                sys.exit()
     ima=IMApp(db, options.ibus)
     signal(SIGTERM, lambda signum, stack_frame: cleanup(ima))
     signal(SIGINT, lambda signum, stack_frame: cleanup(ima))
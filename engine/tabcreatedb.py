@@ -27,8 +27,21 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import tabsqlitedb
+import tabdict
 import bz2
 import re
+import copy
+import glob
+import traceback
+import hashlib
+import shutil
+import sqlite3
+import tempfile
+import time
+import itertools
+import heapq
+import marshal
+import multiprocessing
 
 from optparse import OptionParser
 
@@ -51,6 +64,93 @@ def gconf_valid_keyname(kn):
     """
     return not any(c in _invalid_keyname_chars or ord(c) > 127 for c in kn)
 
+def input_hash(opts):
+    """
+    Return the sha1 hex digest of what the database is built from: the
+    sources, the builder itself and the options which change the result
+    """
+    _hash = hashlib.sha1()
+
+    def add_file(label, filename):
+        _hash.update('%s %d\n' % (label, os.path.getsize(filename)))
+        f = open(filename, 'rb')
+        try:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                _hash.update(chunk)
+        finally:
+            f.close()
+
+    for module in (__file__, tabsqlitedb.__file__,
+                   tabsqlitedb.tabmmap.__file__, tabdict.__file__):
+        source = os.path.splitext(module)[0] + '.py'
+        add_file('builder', source if os.path.exists(source) else module)
+    # the name is the default of the uuid
+    _hash.update(repr((os.path.basename(opts.name), opts.index, opts.binary,
+                       opts.top_phrases, opts.top_prefix_len,
+                       os.environ.get('SOURCE_DATE_EPOCH'))))
+    add_file('source', opts.source)
+    if opts.extra:
+        add_file('extra', opts.extra)
+    if os.path.exists(opts.pinyin):
+        add_file('pinyin', opts.pinyin)
+    return _hash.hexdigest()
+
+def serial_number(build_hash):
+    """
+    Return the serial_number of the tables which do not set it: the date
+    of SOURCE_DATE_EPOCH as YYYYMMDD, or the start of build_hash, so that
+    the same inputs give the same database
+    """
+    if 'SOURCE_DATE_EPOCH' in os.environ:
+        return time.strftime('%Y%m%d', time.gmtime(
+            int(os.environ['SOURCE_DATE_EPOCH'])))
+    return build_hash[:8]
+
+def built_hash(filename):
+    """
+    Return the input_hash the database filename was built from, None if
+    we do not know it
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        db = sqlite3.connect(filename)
+        try:
+            return db.execute('SELECT val FROM main.ime '
+                              'WHERE attr = "build_hash";').fetchall()[0][0]
+        finally:
+            db.close()
+    except (sqlite3.Error, IndexError):
+        return None
+
+def copy_file(src, dst):
+    """
+    Copy src to dst, dst is replaced at once
+    """
+    tmp = '%s.tmp.%d' % (dst, os.getpid())
+    shutil.copyfile(src, tmp)
+    os.rename(tmp, dst)
+
+def db_name(source):
+    """
+    Return the default database name of the table source
+    """
+    return os.path.basename(source).split('.')[0] + '.db'
+
+def table_sources(paths):
+    """
+    Return the table sources of paths, a directory gives the sources
+    directly in it
+    """
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            sources.extend(sorted(glob.glob(os.path.join(path, '*.txt'))
+                                  + glob.glob(os.path.join(path, '*.txt.bz2'))))
+        else:
+            sources.append(path)
+    return sources
+
 class InvalidTableName(Exception):
     """
     Raised when an invalid table name is given
@@ -63,7 +163,7 @@ class InvalidTableName(Exception):
                 ' be all ascii') % (self.table_name, _invalid_keyname_chars)
 
 # we use OptionParser to parse the cmd arguments :)
-opt_parser = OptionParser()
+opt_parser = OptionParser(usage='%prog [options] [SOURCE|DIRECTORY ...]')
 
 opt_parser.add_option(
     '-n', '--name', action='store', dest='name',default=None,
@@ -94,11 +194,53 @@ opt_parser.add_option(
           'normal user should not invoke this flag!')
 )
 
+opt_parser.add_option(
+    '-u', '--update', action='store_true', dest='update', default=False,
+    help=('update the existing database from the changed sources, only '
+          'the phrases which changed are written, default: %default')
+)
+
+opt_parser.add_option(
+    '-c', '--cache-dir', action='store', dest='cache_dir', default='',
+    help=('keep the databases we build in this directory, keyed by the '
+          'hash of their sources, and copy them from there when we are '
+          'asked to build the same again')
+)
+
 opt_parser.add_option(
     '-i', '--create-index-only', action='store_true', dest='only_index',
     default=False, help='only create index on exist database'
 )
 
+opt_parser.add_option(
+    '-b', '--binary', action='store_true', dest='binary', default=False,
+    help=('also write a read only binary image of the phrases, which '
+          'engines mmap instead of reading the database')
+)
+
+opt_parser.add_option(
+    '-t', '--top-phrases', action='store', type='int', dest='top_phrases',
+    default=0,
+    help=('precompute this many candidates of every short prefix, so that '
+          'engines do not select all completions of them, default is '
+          '%default, which disables it')
+)
+
+opt_parser.add_option(
+    '-l', '--top-prefix-length', action='store', type='int',
+    dest='top_prefix_len', default=2,
+    help=('precompute the candidates of prefixes up to this length, '
+          'default is %default')
+)
+
+opt_parser.add_option(
+    '-j', '--jobs', action='store', type='int', dest='jobs', default=None,
+    help=('classify the phrases of chinese tables in this many processes, '
+          'or build this many tables at once when we are given several '
+          'sources, default is 1 for one table and the number of cpus '
+          'for several')
+)
+
 opt_parser.add_option(
     '-d', '--debug', action='store_true', dest='debug', default=False,
     help = 'print extra debug messages'
@@ -107,68 +249,132 @@ opt_parser.add_option(
 
 
 opts,args = opt_parser.parse_args()
+if args and (opts.name or opts.extra or opts.only_index):
+    print ('--name, --extra and --create-index-only are for one table, '
+           'please build the tables with them one by one')
+    sys.exit(2)
+
 if not opts.name and opts.only_index:
     print 'Please give me the database you want to create index on'
     sys.exit(2)
 
 if not opts.name:
-    opts.name = os.path.basename(opts.source).split('.')[0] + '.db'
+    opts.name = db_name(opts.source)
 
+if not opts.jobs:
+    opts.jobs = multiprocessing.cpu_count() if args else 1
 
-def main():
+
+def build(opts):
     def debug_print(message):
         if opts.debug:
             print message
 
+    # the database is up to date if it was built from the same inputs,
+    # or we may have built it before
+    build_hash = None
     if not opts.only_index:
+        build_hash = input_hash(opts)
+        image = tabsqlitedb.tabmmap.image_name(opts.name)
+        if (built_hash(opts.name) == build_hash
+                and (not opts.binary or os.path.exists(image))):
+            debug_print('%s is up to date' % opts.name)
+            return 0
+        if opts.cache_dir:
+            cached = os.path.join(opts.cache_dir, build_hash + '.db')
+            cached_image = tabsqlitedb.tabmmap.image_name(cached)
+            if (os.path.exists(cached)
+                    and (not opts.binary or os.path.exists(cached_image))):
+                copy_file(cached, opts.name)
+                if opts.binary:
+                    copy_file(cached_image, image)
+                debug_print('Copy %s from the cache' % opts.name)
+                return 0
+
+    # update the existing database in place, see phrase_changes
+    update = (opts.update and not opts.only_index
+              and os.path.exists(opts.name))
+    if not opts.only_index and not update:
         try:
             os.unlink(opts.name)
         except:
             pass
 
+    # fork the workers before we open the database, they share the
+    # charset table instead of generating their own
+    pool = None
+    if opts.jobs > 1 and not opts.only_index:
+        tabsqlitedb.charset_table()
+        pool = multiprocessing.Pool(opts.jobs)
+
     debug_print("Processing Database")
     db = tabsqlitedb.tabsqlitedb(filename = opts.name)
     #db.db.execute( 'PRAGMA synchronous = FULL; ' )
 
-    def parse_source(f):
-        _attri = []
-        _table = []
-        _gouci = []
+    def open_source(filename):
+        '''Open filename, decompress it on the fly if it is bz2'''
+        if re.match(r'.*\.bz2', filename):
+            return bz2.BZ2File(filename, "r")
+        return open(filename, 'r')
+
+    def classify_source(f):
+        '''Yield (kind, line) for the lines of the table source f, kind
+        is "table", "gouci" or "attr"'''
         patt_com = re.compile(r'^###.*')
         patt_blank = re.compile(r'^[ \t]*$')
         patt_conf = re.compile(r'[^\t]*=[^\t]*')
         patt_table = re.compile(r'([^\t]+)\t([^\t]+)\t([^t]+)(\t.*)?$')
         patt_gouci = re.compile(r' *[^\s]+ *\t *[^\s]+ *$')
-        patt_s = re.compile(r' *([^\s]+) *\t *([\x00-\xff]{3}) *\t *[^\s]+ *$')
 
         for l in f:
             if (not patt_com.match(l)) and (not patt_blank.match(l)):
-                for _patt, _list in ((patt_table,_table),
-                                     (patt_gouci,_gouci),
-                                     (patt_conf,_attri)):
+                for _patt, _kind in ((patt_table, 'table'),
+                                     (patt_gouci, 'gouci'),
+                                     (patt_conf, 'attr')):
                     if _patt.match(l):
-                        _list.append(l)
+                        yield (_kind, l)
                         break
-        if not _gouci:
-            # user didn't provide goucima, so we use the longest single
-            # character encode as the goucima.
-            gouci_dict = {}
-            for line in _table:
-                res = patt_s.match(line)
-                if res:
-                    if gouci_dict.has_key(res.group(2)):
-                        if len(res.group(1)) > len(gouci_dict[res.group(2)]):
-                            gouci_dict[res.group(2)] = res.group(1)
-                    else:
-                        gouci_dict[res.group(2)] = res.group(1)
-            for key in gouci_dict:
-                _gouci.append('%s\t%s' %(key,gouci_dict[key]))
-            _gouci.sort()
 
-        return (_attri, _table, _gouci)
+    def scan_source(f):
+        '''First pass over the source, return the attribute lines and
+        whether it has goucima lines'''
+        _attri = []
+        _has_gouci = False
+        for _kind, l in classify_source(f):
+            if _kind == 'attr':
+                _attri.append(l)
+            elif _kind == 'gouci':
+                _has_gouci = True
+        return (_attri, _has_gouci)
+
+    def table_lines(f, spill, infer_gouci):
+        '''Second pass over the source, yield the table lines and write
+        the goucima lines into spill. If infer_gouci, the source has no
+        goucima, and we write the code of every single character there
+        instead.'''
+        patt_s = re.compile(r' *([^\s]+) *\t *([\x00-\xff]{3}) *\t *[^\s]+ *$')
+        for _kind, l in classify_source(f):
+            if _kind == 'table':
+                if infer_gouci:
+                    res = patt_s.match(l)
+                    if res:
+                        spill.write('%s\t%s\n' % (res.group(2), res.group(1)))
+                yield l
+            elif _kind == 'gouci' and spill:
+                spill.write(l.rstrip('\r\n') + '\n')
+
+    def infer_gouci(spill):
+        '''Use the longest code of every single character in spill as
+        its goucima'''
+        gouci_dict = {}
+        for line in spill:
+            zi, code = line.rstrip('\n').split('\t')
+            if len(code) > len(gouci_dict.get(zi, '')):
+                gouci_dict[zi] = code
+        for key in sorted(gouci_dict):
+            yield '%s\t%s' % (key, gouci_dict[key])
 
     def parse_pinyin (f):
-        _pinyins = []
         patt_com = re.compile(r'^#.*')
         patt_blank = re.compile(r'^[ \t]*$')
         patt_py = re.compile(r'(.*)\t(.*)\t(.*)')
@@ -180,12 +386,10 @@ def main():
                 if res:
                     yins = patt_yin.findall(res.group(2))
                     for yin in yins:
-                        _pinyins.append("%s\t%s\t%s" \
-                                % (res.group(1), yin, res.group(3)))
-        return _pinyins[:]
+                        yield "%s\t%s\t%s" % (res.group(1), yin,
+                                               res.group(3))
 
     def parse_extra(f):
-        _extra = []
         patt_com = re.compile(r'^###.*')
         patt_blank = re.compile(r'^[ \t]*$')
         patt_extra = re.compile(r'(.*)\t(.*)')
@@ -194,9 +398,7 @@ def main():
         for l in f:
             if ( not patt_com.match(l) ) and ( not patt_blank.match(l) ):
                 if patt_extra.match(l):
-                    _extra.append(l)
-
-        return _extra
+                    yield l
 
     def pinyin_parser(f):
         for py in f:
@@ -204,13 +406,17 @@ def main():
             yield (_pinyin, _zi, _freq)
 
     def phrase_parser(f):
-        list=[]
         for l in f:
-            xingma, phrase, freq = unicode(l, "utf-8").strip().split('\t')[:3]
+            try:
+                xingma, phrase, freq = unicode(
+                    l, "utf-8").strip().split('\t')[:3]
+                freq = int(freq)
+            except ValueError:
+                print 'bad table line: %s' % l.strip()
+                continue
             if phrase == 'NOSYMBOL':
                 phrase = u''
-            list.append((xingma, phrase, int(freq), 0))
-        return list
+            yield (xingma, phrase, freq, 0)
 
     def goucima_parser(f):
         for l in f:
@@ -232,109 +438,301 @@ def main():
             yield (attr,val)
 
     def extra_parser(f):
-        list = []
         for l in f:
             phrase, freq = unicode(l, "utf-8").strip().split()
             try:
                 _tabkey = db.parse_phrase_to_tabkeys(phrase)
-                list.append((_tabkey,phrase,freq,0))
+                yield (_tabkey,phrase,freq,0)
             except:
                 print '\"%s\" would not been added' % phrase.encode('utf-8')
-        return list
+
+    def external_sort(items, key, run_size=200000):
+        '''Return an iterator of items sorted by key, items with the
+        same key stay in their order. items are read now, in runs of
+        run_size which are sorted in memory, if there are more of them,
+        the sorted runs are spilled into temporary files and merged
+        while we iterate.'''
+        def read_run(f, n):
+            # items of the nth run, which come before the items of the
+            # later runs with the same key
+            f.seek(0)
+            while True:
+                try:
+                    x = marshal.load(f)
+                except EOFError:
+                    f.close()
+                    return
+                yield (key(x), n, x)
+
+        items = iter(items)
+        runs = []
+        while True:
+            run = sorted(itertools.islice(items, run_size), key=key)
+            if not run:
+                break
+            if not runs and len(run) < run_size:
+                # it fits in one run
+                return iter(run)
+            f = tempfile.TemporaryFile()
+            map(lambda x: marshal.dump(x, f), run)
+            runs.append(read_run(f, len(runs)))
+        return itertools.imap(lambda x: x[2], heapq.merge(*runs))
+
+    # every key as the character of its tabkey id, strings of them sort
+    # like the tabkey ids
+    tabkey_chars = dict(map(lambda (k, i): (ord(k), unichr(i)),
+                            tabdict.tab_dict.items()))
+    # add_pinyin stores the tones as the keys !@#$%
+    pinyin_chars = dict(tabkey_chars)
+    pinyin_chars.update(map(lambda (t, k): (ord(t), tabkey_chars[ord(k)]),
+                            zip(u'12345', u'!@#$%')))
+
+    def pinyin_key(x):
+        '''Sort key of the rows of pinyin_parser, they are inserted in
+        the order of p0, ..., p5, plen'''
+        _ids = x[0].translate(pinyin_chars)
+        return (_ids[:6], len(_ids))
+
+    def phrase_key(x):
+        '''Sort key of (tabkeys, phrase, freq, user_freq), in the order
+        of the code and phrase columns of main.phrases'''
+        return (x[0].translate(tabkey_chars).encode('latin-1', 'replace'),
+                x[1].encode('utf8'))
+
+    def sorted_phrases(phrases):
+        '''Return an iterator of (phrase_key(x), x) of phrases, sorted
+        by the key'''
+        return external_sort(itertools.imap(lambda x: (phrase_key(x), x),
+                                            phrases),
+                             lambda x: x[0])
+
+    def with_extras(phrases, extras):
+        '''Merge the sorted extras into the sorted phrases, an extra
+        word is only added if the table does not have it, like
+        new_extra_phrases does'''
+        extras = itertools.imap(lambda (key, x): next(x),
+                                itertools.groupby(extras, lambda x: x[0]))
+        extra = next(extras, None)
+        for x in phrases:
+            while extra and extra[0] < x[0]:
+                yield extra
+                extra = next(extras, None)
+            if extra and extra[0] == x[0]:
+                extra = next(extras, None)
+            yield x
+        while extra:
+            yield extra
+            extra = next(extras, None)
+
+    def phrase_changes(phrases):
+        '''Compare phrases, (phrase_key(x), x) sorted by the key, with
+        main.phrases by (code, phrase). Return the phrases to add, the
+        (freq, id) of the rows whose freq changed and the ids of the rows
+        to delete. The rows which are still in the source keep their
+        ids.'''
+        rows = itertools.imap(
+            lambda x: ((str(x[1]), x[2].encode('utf8')), x),
+            db.phrase_keys())
+        inserts = []
+        freqs = []
+        deletes = []
+        new = next(phrases, None)
+        old = next(rows, None)
+        while new or old:
+            if not old or (new and new[0] < old[0]):
+                inserts.append(new[1])
+                new = next(phrases, None)
+            elif not new or old[0] < new[0]:
+                deletes.append(old[1][0])
+                old = next(rows, None)
+            else:
+                # phrases and rows with the same key are paired in order
+                if unicode(new[1][2]) != unicode(old[1][3]):
+                    freqs.append((new[1][2], old[1][0]))
+                new = next(phrases, None)
+                old = next(rows, None)
+        return (inserts, freqs, deletes)
+
+    def goucima_rows(spill, has_gouci):
+        '''Return the goucima in spill, sorted by zi'''
+        debug_print('\t  get goucima of IME :)')
+        spill.seek(0)
+        if has_gouci:
+            return goucima_parser(external_sort(
+                spill, lambda x: x.split()[0]))
+        # infer_gouci sorts them already
+        return goucima_parser(infer_gouci(spill))
+
+    def pinyin_rows():
+        '''Return the rows of the pinyin source, in the order of the
+        pinyin table'''
+        debug_print('\tLoad pinyin source \"%s\"' % opts.pinyin)
+        pinyin_s = open_source(opts.pinyin)
+        debug_print('\tParsing pinyin source file ')
+        pyline = parse_pinyin(pinyin_s)
+        debug_print('\tPreapring pinyin entries')
+        return external_sort(pinyin_parser(pyline), pinyin_key)
+
+    def extra_words():
+        '''Return the phrases of the extra words source'''
+        debug_print('\tLoad extra words source \"%s\"' % opts.extra)
+        extra_s = open_source(opts.extra)
+        debug_print('\tParsing extra words source file ')
+        extraline = parse_extra(extra_s)
+        debug_print('\tPreparing extra words lines')
+        db.cache_goucima()
+        debug_print('\t  Goucima has been cache to memory')
+        return extra_parser(extraline)
+
+    def new_extra_phrases(extrawds, chunk_size=4096):
+        '''Yield chunks of the extra phrases which are not in the table
+        yet, the earlier chunks are in db when we check the later ones'''
+        while True:
+            chunk = list(itertools.islice(extrawds, chunk_size))
+            if not chunk:
+                break
+            seen = set()
+            new_phrases = []
+            for x in chunk:
+                if (x[0], x[1]) in seen or db.has_phrase(x[0], x[1]):
+                    continue
+                seen.add((x[0], x[1]))
+                new_phrases.append(x)
+            yield new_phrases
 
     if opts.only_index:
         debug_print('Only create Indexes')
-        debug_print("Optimizing database ")
-        db.optimize_database()
-
         debug_print('Create Indexes ')
         db.create_indexes('main')
+        if opts.top_phrases > 0:
+            debug_print('Build top phrases of short prefixes')
+            db.build_top_phrases(opts.top_phrases, opts.top_prefix_len)
+        if opts.binary:
+            debug_print('Write phrase image')
+            db.write_phrase_image(opts.name)
         debug_print ('Done! :D')
         return 0
 
-    # now we parse the ime source file
+    # now we parse the ime source file, in two streaming passes, the
+    # first one for the attributes, since we need them before we can
+    # add any phrase
     debug_print("\tLoad sources \"%s\"" % opts.source)
-    patt_s = re.compile(r'.*\.bz2')
-    _bz2s = patt_s.match(opts.source)
-    if _bz2s:
-        source = bz2.BZ2File(opts.source, "r")
-    else:
-        source = open(opts.source, 'r')
-    # first get config line and table line and goucima line respectively
     debug_print('\tParsing table source file ')
-    attri,table,gouci =  parse_source(source)
+    attri, has_gouci = scan_source(open_source(opts.source))
 
     debug_print('\t  get attribute of IME :)')
-    attributes = attribute_parser(attri)
-    debug_print('\t  add attributes into DB ')
-    db.update_ime(attributes)
+    source_attributes = list(attribute_parser(attri))
+    if not filter(lambda x: x[0] == 'serial_number', source_attributes):
+        # the default of tabsqlitedb is today
+        source_attributes.append(('serial_number', serial_number(build_hash)))
+    attributes = source_attributes
+    if update:
+        # what a full build gives, the attributes removed from the source
+        # go back to their defaults, update_ime ignores any other
+        full = tabsqlitedb.ime_defaults(opts.name)
+        full.update(filter(lambda x: x[0] in full, source_attributes))
+        attributes = filter(
+            lambda (attr, val): db.get_ime_property(attr) != val,
+            sorted(full.items()))
+        if not db.has_code_column('main') or filter(
+                lambda x: x[0] in ('max_key_length', 'languages'),
+                attributes):
+            # the columns of phrases change
+            debug_print('\t  the layout of the table changed, '
+                        'create it from scratch')
+            db.db.close()
+            os.unlink(opts.name)
+            db = tabsqlitedb.tabsqlitedb(filename = opts.name)
+            attributes = source_attributes
+            update = False
+    if attributes:
+        debug_print('\t  add attributes into DB ')
+        db.update_ime(attributes)
     db.create_tables('main')
 
-    # second, we use generators for database generating:
-    debug_print('\t  get phrases of IME :)')
-    phrases = phrase_parser(table)
-
-    # now we add things into db
-    debug_print('\t  add phrases into DB ')
-    db.add_phrases(phrases)
-
+    # the goucima lines, or the single character codes we infer the
+    # goucima from, are spilled into a temporary file while we go
+    # through the table
     if db.get_ime_property('user_can_define_phrase').lower() == u'true':
-        debug_print('\t  get goucima of IME :)')
-        goucima = goucima_parser(gouci)
-        debug_print('\t  add goucima into DB ')
-        db.add_goucima(goucima)
-
-    if db.get_ime_property('pinyin_mode').lower() == u'true':
-        debug_print('\tLoad pinyin source \"%s\"' % opts.pinyin)
-        _bz2p = patt_s.match(opts.pinyin)
-        if _bz2p:
-            pinyin_s = bz2.BZ2File(opts.pinyin, "r")
-        else:
-            pinyin_s = open(opts.pinyin, 'r')
-        debug_print('\tParsing pinyin source file ')
-        pyline = parse_pinyin(pinyin_s)
-        debug_print('\tPreapring pinyin entries')
-        pinyin = pinyin_parser(pyline)
-        debug_print('\t  add pinyin into DB ')
-        db.add_pinyin( pinyin )
-
-    debug_print("Optimizing database ")
-    db.optimize_database()
+        spill = tempfile.TemporaryFile()
+    else:
+        spill = None
+    has_pinyin = db.get_ime_property('pinyin_mode').lower() == u'true'
+    has_extra = bool(spill and opts.extra)
 
-    if db.get_ime_property(
-            'user_can_define_phrase').lower() == u'true' and opts.extra:
-        debug_print( '\tPreparing for adding extra words')
-        db.create_indexes('main')
-        debug_print('\tLoad extra words source \"%s\"' % opts.extra)
-        _bz2p = patt_s.match(opts.extra)
-        if _bz2p:
-            extra_s = bz2.BZ2File(opts.extra, "r")
-        else:
-            extra_s = file(opts.extra, 'r')
-        debug_print('\tParsing extra words source file ')
-        extraline = parse_extra(extra_s)
-        debug_print('\tPreparing extra words lines')
-        db.cache_goucima()
-        debug_print('\t  Goucima has been cache to memory')
-        extrawds = extra_parser(extraline)
-        debug_print('\t  we have %d extra phrases from source' % len(extrawds))
-        # first get the entry of original phrases from
-        # phrases-[(xingma, phrase, int(freq), 0)]
-        orig_phrases = {}
-        map(lambda x: orig_phrases.update({"%s\t%s"%(x[0],x[1]):x}), phrases)
-        debug_print('\t  the len of orig_phrases is: %d' % len(orig_phrases))
-        extra_phrases = {}
-        map(lambda x: extra_phrases.update({"%s\t%s" %(x[0],x[1]):x}), extrawds)
-        debug_print('\t  the len of extra_phrases is: %d' % len(extra_phrases))
-        # pop duplicated keys
-        map(lambda x: extra_phrases.pop(x)\
-            if orig_phrases.has_key(x) else 0, extra_phrases.keys())
-        debug_print('\t  %d extra phrases will be added' % len(extra_phrases))
-        new_phrases = extra_phrases.values()
-        debug_print('\tAdding extra words into DB ')
-        db.add_phrases(new_phrases)
-        debug_print("Optimizing database ")
-        db.optimize_database()
+    # second, we use generators for database generating:
+    debug_print('\t  get phrases of IME :)')
+    phrases = phrase_parser(table_lines(open_source(opts.source), spill,
+                                       spill and not has_gouci))
+
+    if update:
+        # goucima and pinyin are replaced if they changed, the phrases
+        # are compared with main.phrases
+        debug_print('\t  compare phrases with DB ')
+        phrases = sorted_phrases(phrases)
+        goucima = []
+        if spill:
+            # the first goucima of a zi wins, like in add_goucima
+            goucima = map(lambda (zi, x): next(x), itertools.groupby(
+                db.goucima_records(goucima_rows(spill, has_gouci)),
+                lambda x: x[0]))
+            spill.close()
+        if db.replace_rows('goucima', goucima):
+            debug_print('\t  goucima has been replaced')
+        pinyin = []
+        if has_pinyin:
+            pinyin = list(db.pinyin_records(pinyin_rows()))
+        if db.replace_rows('pinyin', pinyin):
+            debug_print('\t  pinyin has been replaced')
+        if has_extra:
+            phrases = with_extras(phrases, sorted_phrases(extra_words()))
+        inserts, freqs, deletes = phrase_changes(phrases)
+        count = db.apply_phrase_changes(inserts, freqs, deletes, pool=pool,
+                                        jobs=opts.jobs)
+        debug_print('\t  %d phrases have been added, %d updated, '
+                    '%d deleted' % (count, len(freqs), len(deletes)))
+    else:
+        # now we add things into db, every table is written in its final
+        # order, so that we do not need to rewrite the database. The
+        # rows of phrases are in the order of their ids already.
+        debug_print('\t  add phrases into DB ')
+        db.add_phrases(phrases, pool=pool, jobs=opts.jobs)
+
+        if spill:
+            goucima = goucima_rows(spill, has_gouci)
+            debug_print('\t  add goucima into DB ')
+            db.add_goucima(goucima)
+            spill.close()
+
+        if has_pinyin:
+            pinyin = pinyin_rows()
+            debug_print('\t  add pinyin into DB ')
+            db.add_pinyin( pinyin )
+
+        if has_extra:
+            debug_print( '\tPreparing for adding extra words')
+            # the other indexes are created once all phrases are in
+            db.create_lookup_index('main')
+            extrawds = extra_words()
+            # drop the extra phrases the table has already
+            debug_print('\tAdding extra words into DB ')
+            count = 0
+            for new_phrases in new_extra_phrases(extrawds):
+                count += db.bulk_add_phrases(new_phrases, pool=pool,
+                                         jobs=opts.jobs)
+            debug_print('\t  %d extra phrases have been added' % count)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    if update:
+        # what the last build left, and we do not build this time, is
+        # outdated now
+        if opts.top_phrases <= 0:
+            db.drop_top_phrases()
+        if not opts.binary and db.get_ime_property('binary_checksum'):
+            db.set_ime_property('binary_checksum', '')
 
     if opts.index:
         debug_print('Create Indexes ')
@@ -344,7 +742,106 @@ def main():
                     "you should only active this function "
                     "only for distribution purpose")
         db.drop_indexes('main')
+    if opts.top_phrases > 0:
+        debug_print('Build top phrases of short prefixes')
+        db.build_top_phrases(opts.top_phrases, opts.top_prefix_len)
+    if opts.binary:
+        debug_print('Write phrase image')
+        db.write_phrase_image(opts.name)
+    db.set_ime_property('build_hash', build_hash)
+    if opts.cache_dir and not update:
+        # only what a full build gives, the ids of the rows an update
+        # adds differ
+        debug_print('Copy %s into the cache' % opts.name)
+        if not os.path.isdir(opts.cache_dir):
+            os.makedirs(opts.cache_dir)
+        copy_file(opts.name, cached)
+        if opts.binary:
+            copy_file(image, cached_image)
     debug_print('Done! :D')
 
+def build_logged(opts):
+    """
+    Build the table of opts in a worker of build_all, return (opts,
+    whether it is built, what the build printed)
+    """
+    log = tempfile.TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # tabsqlitedb prints to the stderr it imported, so redirect the fds
+    saved = map(os.dup, (1, 2))
+    for fd in (1, 2):
+        os.dup2(log.fileno(), fd)
+    ok = False
+    try:
+        try:
+            build(opts)
+            ok = True
+        except Exception:
+            traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        map(os.dup2, saved, (1, 2))
+        map(os.close, saved)
+    log.seek(0)
+    return opts, ok, log.read()
+
+def build_all(opts, sources):
+    """
+    Build the tables of sources in opts.jobs processes, print the log of
+    every table once it is done, return the sources which failed
+    """
+    tables = []
+    names = {}
+    for source in sources:
+        table = copy.copy(opts)
+        table.source = source
+        table.name = db_name(source)
+        # workers of a pool cannot have workers of their own
+        table.jobs = 1
+        if table.name in names:
+            print >> sys.stderr, '%s and %s are both built into %s' % (
+                names[table.name], source, table.name)
+            return sources
+        names[table.name] = source
+        tables.append(table)
+    if not tables:
+        return []
+    # the largest first, so that no long build is left alone at the end
+    tables.sort(key=lambda x: os.path.getsize(x.source)
+                if os.path.isfile(x.source) else 0, reverse=True)
+    # every table is built in a fresh process, nothing is shared between
+    # the builds but the charset table generated here
+    tabsqlitedb.charset_table()
+    pool = multiprocessing.Pool(min(opts.jobs, len(tables)),
+                                maxtasksperchild=1)
+    failed = []
+    try:
+        for table, ok, log in pool.imap_unordered(build_logged, tables):
+            print '%s %s from %s' % ('Built' if ok else 'FAILED to build',
+                                     table.name, table.source)
+            sys.stdout.write(log)
+            sys.stdout.flush()
+            if not ok:
+                failed.append(table.source)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+def main():
+    if not args:
+        return build(opts)
+    sources = table_sources(args)
+    failed = build_all(opts, sources)
+    if failed:
+        print >> sys.stderr, '%d of %d tables failed:' % (len(failed),
+                                                          len(sources))
+        for source in failed:
+            print >> sys.stderr, '\t%s' % source
+        return 1
+    return 0
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# vim:et sts=4 sw=4
+#
+# ibus-table - The Tables engine for IBus
+#
+# Copyright (c) 2008-2013 Yuwei Yu <acevery@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# $Id: $
+#
+
+# Append only journal of the mudb changes of one engine process, so
+# that the learned phrases survive a crash before sync_usrdb writes them
+# into user_db.
+#
+# The journal of a process is <user_db>.learn.<pid>.<token>, a journal
+# taken over from a dead process is <user_db>.replay.<pid>.<token>.
+# The layout of the file is:
+#   header:  magic
+#   records: (freq, mlen, category, user_freq delta, phrase length),
+#            tabkey ids one byte each, utf-8 encoded phrase
+# freq is the mudb freq of the row, 0 means the phrase was removed.
+
+import os
+import errno
+import glob
+import struct
+import uuid
+
+MAGIC = 'IBTJ'
+
+_record = struct.Struct('<bBBiH')
+
+# tokens of the journals opened by this process
+_tokens = set()
+
+
+def journal_name(user_db, token, state='learn', pid=None):
+    '''Return the file name of the journal token of user_db'''
+    return '%s.%s.%d.%s' % (user_db, state, pid or os.getpid(), token)
+
+
+def pack(freq, tabkey_ids, category, phrase, delta):
+    '''Return a journal record'''
+    phrase = phrase.encode('utf8')
+    return (_record.pack(freq, len(tabkey_ids), category, delta, len(phrase))
+            + ''.join(map(chr, tabkey_ids)) + phrase)
+
+
+def read_records(filename, offset=0):
+    '''Return the records of journal filename after offset as a list of
+    (freq, tabkey ids, category, phrase, delta), a record cut short by
+    a crash is ignored
+    '''
+    f = open(filename, 'rb')
+    try:
+        buf = f.read()
+    finally:
+        f.close()
+    if buf[:len(MAGIC)] != MAGIC:
+        return []
+    pos = max(offset, len(MAGIC))
+    records = []
+    while pos + _record.size <= len(buf):
+        freq, mlen, category, delta, phrase_len = _record.unpack_from(buf, pos)
+        pos += _record.size
+        if pos + mlen + phrase_len > len(buf):
+            break
+        tabkey_ids = tuple(map(ord, buf[pos:pos+mlen]))
+        pos += mlen
+        phrase = buf[pos:pos+phrase_len].decode('utf8')
+        pos += phrase_len
+        records.append((freq, tabkey_ids, category, phrase, delta))
+    return records
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def claim_orphans(user_db):
+    '''Take over the journals of user_db left by dead processes, return
+    a list of (file name, token) of them'''
+    orphans = []
+    for filename in glob.glob(user_db + '.*.*.*'):
+        try:
+            state, pid, token = filename[len(user_db)+1:].split('.')
+            pid = int(pid)
+        except ValueError:
+            continue
+        if (state not in ('learn', 'replay') or token in _tokens
+                or (pid != os.getpid() and is_alive(pid))):
+            continue
+        new_name = journal_name(user_db, token, 'replay')
+        try:
+            # only one of the processes starting now gets it
+            os.rename(filename, new_name)
+        except OSError:
+            continue
+        orphans.append((new_name, token))
+    return orphans
+
+
+def tokens(user_db):
+    '''Return the tokens of the existing journals of user_db'''
+    return set(map(lambda x: x.split('.')[-1],
+                   glob.glob(user_db + '.*.*.*')))
+
+
+class tabjournal(object):
+    '''Journal of the mudb changes of this process, the file is created
+    when the first record is flushed'''
+    def __init__(self, user_db):
+        self._user_db = user_db
+        self._file = None
+        self._buf = []
+        self.new_token()
+
+    def new_token(self):
+        self.token = uuid.uuid4().hex[:12]
+        _tokens.add(self.token)
+        self.filename = journal_name(self._user_db, self.token)
+        self.size = len(MAGIC)
+
+    def append(self, freq, tabkey_ids, category, phrase, delta):
+        '''Add a record, it is written by the next flush'''
+        record = pack(freq, tabkey_ids, category, phrase, delta)
+        self._buf.append(record)
+        self.size += len(record)
+
+    def flush(self):
+        '''Write the records added since last flush and fsync them'''
+        if not self._buf:
+            return
+        if not self._file:
+            self._file = open(self.filename, 'ab')
+            self._file.write(MAGIC)
+        self._file.write(''.join(self._buf))
+        self._buf = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def rotate(self):
+        '''Drop the records, they are in user_db now, and start a new
+        journal'''
+        self._buf = []
+        if self._file:
+            self._file.close()
+            self._file = None
+            os.unlink(self.filename)
+        _tokens.discard(self.token)
+        self.new_token()
+
+    def close(self):
+        self.flush()
+        if self._file:
+            self._file.close()
+            self._file = None
@@ -30,6 +30,7 @@ import os
 
 from gi.repository import IBus
 import tabdict
+import tabsqlitedb
 
 import re
 patt_edit = re.compile(r'(.*)###(.*)###(.*)')
@@ -181,6 +182,10 @@ class Editor(object):
         self._cursor = [0,0]
         # self._candidates: hold candidates selected from database [[now],[pre]]
         self._candidates = [[],[]]
+        # self._prefix_results: stack of tabsqlitedb.prefix_result for the
+        #     prefixes of self._tabkey_list, so that we can narrow down
+        #     candidates of a longer input without sql enquiry
+        self._prefix_results = []
         # self._lookup_table_size: how many candidates we should hold in ui
         self._lookup_table_size = variant_to_value(
             self._config.get_value(self._config_section,
@@ -188,7 +193,15 @@ class Editor(object):
         )
         if self._lookup_table_size == None:
             self._lookup_table_size = 6
-
+        # self._lazy_lookup_table: only append the candidates of the page
+        #     holding the cursor and the page after it to the lookup table,
+        #     the rest are appended when the cursor gets there
+        self._lazy_lookup_table = variant_to_value(
+            self._config.get_value(self._config_section,
+                                   "LazyLookupTable")
+        )
+        if self._lazy_lookup_table == None:
+            self._lazy_lookup_table = True
 
         self._orientation = variant_to_value(self._config.get_value(
                 self._config_section,
@@ -300,6 +313,7 @@ class Editor(object):
         self._lookup_table.clear()
         self._lookup_table.set_cursor_visible(True)
         self._candidates = [[],[]]
+        self._prefix_results = []
 
     def over_input(self):
         '''
@@ -643,18 +657,31 @@ class Editor(object):
         if not self._chinese_mode in(2,3):
             return candidates[:]
         bm_index = self._pt.index('category')
-        if self._chinese_mode == 2:
-            # big charset with SC first
-            return  filter (lambda x: x[bm_index] & 1, candidates)\
-                    +filter (lambda x: x[bm_index] & (1 << 1) and \
-                            (not x[bm_index] & 1), candidates)\
-                    + filter (lambda x: x[bm_index] & (1 << 2), candidates)
-        elif self._chinese_mode == 3:
-            # big charset with SC first
-            return  filter (lambda x: x[bm_index] & (1 << 1), candidates)\
-                    +filter (lambda x: x[bm_index] & 1 and\
-                    (not x[bm_index] & (1<<1)) , candidates)\
-                    + filter (lambda x: x[bm_index] & (1 << 2), candidates)
+        return tabsqlitedb.group_candidates(candidates, self._chinese_mode,
+                                            bm_index)
+
+    def select_words(self, bitmask=0, mode=None):
+        '''Select candidates of self._tabkey_list from database, reuse
+        the result of the previous input if we can. If mode is given,
+        the candidates are grouped for that ChineseMode.'''
+        _ids = tuple(map(int, self._tabkey_list[:self._max_key_len]))
+        # drop the results which are not for the prefixes of input now
+        while self._prefix_results and not self._prefix_results[-1].matches(
+                _ids, self._onechar, bitmask):
+            self._prefix_results.pop()
+        parent = None
+        if self._prefix_results:
+            parent = self._prefix_results[-1]
+        if parent and parent.tabkey_ids == _ids:
+            # we come back by pop_input
+            res = parent
+        else:
+            res = self.db.select_prefix(self._tabkey_list, self._onechar,
+                                        bitmask, parent)
+            self._prefix_results.append(res)
+        if mode:
+            return res.grouped(mode, self._pt.index('category'))[:]
+        return res.candidates[:]
 
     def update_candidates (self):
         '''Update lookuptable'''
@@ -686,27 +713,25 @@ class Editor(object):
                             bm_index = self._pt.index('category')
                             if self._chinese_mode == 0:
                                 # simplify Chinese mode
-                                self._candidates[0] = self.db.select_words(\
-                                        self._tabkey_list, self._onechar, 1 )
+                                self._candidates[0] = self.select_words(1)
                             elif self._chinese_mode == 1:
                                 # traditional Chinese mode
-                                self._candidates[0] = self.db.select_words(\
-                                        self._tabkey_list, self._onechar, 2 )
+                                self._candidates[0] = self.select_words(2)
                             else:
-                                self._candidates[0] = self.db.select_words(\
-                                        self._tabkey_list, self._onechar )
+                                # grouped by the database result
+                                self._candidates[0] = self.select_words(
+                                    0, self._chinese_mode)
                         else:
-                            self._candidates[0] = self.db.select_words( self._tabkey_list, self._onechar )
+                            self._candidates[0] = self.select_words()
                     else:
-                        self._candidates[0] = self.db.select_zi( self._tabkey_list )
+                        self._candidates[0] = self.filter_candidates (
+                            self.db.select_zi( self._tabkey_list ))
                     self._chars[2] = self._chars[0][:]
 
                 else:
                     self._candidates[0] =[]
                 if self._candidates[0]:
-                    self._candidates[0] = self.filter_candidates (self._candidates[0])
-                if self._candidates[0]:
-                    map(self.ap_candidate, self._candidates[0] )
+                    self.fill_lookup_table()
                 else:
                     if self._chars[0]:
                         ## old manner:
@@ -827,10 +852,27 @@ class Editor(object):
             if len (cstr ) > 1:
                 aux_string += (u'\t#: ' + self.db.parse_phrase_to_tabkeys (cstr))
         return aux_string
+    def fill_lookup_table(self, fill_all=False):
+        '''Append candidates to lookup table, up to the end of the page
+        after the one holding the cursor, or all of them if fill_all
+        is True or lazy lookup table is disabled'''
+        _cands = self._candidates[0]
+        _filled = self._lookup_table.get_number_of_candidates()
+        if fill_all or not self._lazy_lookup_table:
+            _end = len(_cands)
+        else:
+            _size = self._lookup_table_size
+            _end = min(len(_cands),
+                       (self._lookup_table.get_cursor_pos() / _size + 2)
+                       * _size)
+        if _filled < _end:
+            map(self.ap_candidate, _cands[_filled:_end])
+
     def arrow_down(self):
         '''Process Arrow Down Key Event
         Move Lookup Table cursor down'''
         res = self._lookup_table.cursor_down()
+        self.fill_lookup_table()
         self.update_candidates ()
         if not res and self._candidates[0]:
             return True
@@ -839,6 +881,8 @@ class Editor(object):
     def arrow_up(self):
         '''Process Arrow Up Key Event
         Move Lookup Table cursor up'''
+        # cursor wraps to the last candidate
+        self.fill_lookup_table(self._lookup_table.get_cursor_pos() == 0)
         res = self._lookup_table.cursor_up()
         self.update_candidates ()
         if not res and self._candidates[0]:
@@ -849,6 +893,7 @@ class Editor(object):
         '''Process Page Down Key Event
         Move Lookup Table page down'''
         res = self._lookup_table.page_down()
+        self.fill_lookup_table()
         self.update_candidates ()
         if not res and self._candidates[0]:
             return True
@@ -857,6 +902,9 @@ class Editor(object):
     def page_up(self):
         '''Process Page Up Key Event
         move Lookup Table page up'''
+        # cursor wraps to the last page
+        self.fill_lookup_table(
+            self._lookup_table.get_cursor_pos() < self._lookup_table_size)
         res = self._lookup_table.page_up()
         self.update_candidates ()
         if not res and self._candidates[0]:
@@ -884,6 +932,7 @@ class Editor(object):
                 # freq of this candidate is -1, means this a user phrase
                 self.db.remove_phrase (can)
                 # make update_candidates do sql enquiry
+                self._prefix_results = []
                 self._chars[2].pop()
                 self.update_candidates ()
 
@@ -1062,6 +1111,54 @@ class EngineTable(IBus.Engine):
         self._config = self._bus.get_config ()
         self._config.connect ("value-changed", self.config_value_changed_cb)
 
+        # whether we keep main.phrases in memory for faster lookup
+        self._prefix_index = variant_to_value(
+            self._config.get_value(self._config_section, "PrefixIndex"))
+        if self._prefix_index and not (self.db._prefix_index
+                                       or self.db._phrase_image):
+            self.db.build_prefix_index()
+
+        # committed phrases are learned in batches this many milliseconds
+        # later, off the key event path, 0 learns them at once
+        self._learn_delay = variant_to_value(
+            self._config.get_value(self._config_section, "LearnDelay"))
+        if self._learn_delay == None:
+            self._learn_delay = 200
+        self._learn_source = None
+        # the learned phrases are written into user_db every SyncInterval
+        # seconds, or once SyncDirtyRows of them are waiting
+        self._sync_interval = variant_to_value(
+            self._config.get_value(self._config_section, "SyncInterval"))
+        if self._sync_interval == None:
+            self._sync_interval = 60
+        self._sync_dirty_rows = variant_to_value(
+            self._config.get_value(self._config_section, "SyncDirtyRows"))
+        if self._sync_dirty_rows == None:
+            self._sync_dirty_rows = 64
+        self._sync_source = None
+        if self._sync_interval > 0:
+            self._sync_source = GLib.timeout_add_seconds(
+                self._sync_interval, self._sync_usrdb_cb)
+        # user_db is kept under UserDBMaxRows rows, and the user_freq of
+        # the system phrases in it is halved every UserDBHalfLife days,
+        # see tabsqlitedb.compact_usrdb, 0 disables either, the default
+        self._usrdb_max_rows = variant_to_value(
+            self._config.get_value(self._config_section, "UserDBMaxRows"))
+        if self._usrdb_max_rows == None:
+            self._usrdb_max_rows = 0
+        self._usrdb_half_life = variant_to_value(
+            self._config.get_value(self._config_section, "UserDBHalfLife"))
+        if self._usrdb_half_life == None:
+            self._usrdb_half_life = 0
+        # compact once the engine is up, not while it starts, and only
+        # once for the db the engines share
+        self._compact_source = None
+        if ((self._usrdb_max_rows > 0 or self._usrdb_half_life > 0)
+                and not self.db.compact_scheduled):
+            self.db.compact_scheduled = True
+            self._compact_source = GLib.timeout_add_seconds(
+                30, self._compact_usrdb_cb)
+
         # Containers we used:
         self._editor = Editor(self._config, self._pt, self._valid_input_chars, self._ml, self.db)
 
@@ -1151,7 +1248,51 @@ class EngineTable(IBus.Engine):
         self._init_properties ()
         self._update_ui ()
 
+    def check_phrase(self, phrase, tabkey=None):
+        '''Queue the committed phrase for learning, and learn the queue
+        in one transaction when the timeout source fires'''
+        self.db.queue_phrase(phrase, tabkey)
+        if self._learn_delay <= 0:
+            self._learn_phrases_cb()
+        elif not self._learn_source:
+            self._learn_source = GLib.timeout_add(self._learn_delay,
+                                                  self._learn_phrases_cb)
+
+    def _learn_phrases_cb(self):
+        self._learn_source = None
+        self.db.learn_phrases()
+        if (self._sync_dirty_rows > 0
+                and self.db.dirty_phrases() >= self._sync_dirty_rows):
+            self.db.sync_usrdb()
+        return False
+
+    def _sync_usrdb_cb(self):
+        self.db.sync_usrdb()
+        return True
+
+    def _compact_usrdb_cb(self):
+        # wait until no key event is pending
+        self._compact_source = GLib.idle_add(self._compact_usrdb_idle_cb)
+        return False
+
+    def _compact_usrdb_idle_cb(self):
+        self._compact_source = None
+        self.db.compact_usrdb(self._usrdb_max_rows, self._usrdb_half_life)
+        return False
+
     def do_destroy(self):
+        if self._learn_source:
+            GLib.source_remove(self._learn_source)
+            self._learn_source = None
+        if self._sync_source:
+            GLib.source_remove(self._sync_source)
+            self._sync_source = None
+        if self._compact_source:
+            GLib.source_remove(self._compact_source)
+            self._compact_source = None
+            # let the next engine compact it
+            self.db.compact_scheduled = False
+        self.db.learn_phrases()
         self.reset ()
         self.do_focus_out ()
         #self.db.sync_usrdb ()
@@ -1761,7 +1902,7 @@ class EngineTable(IBus.Engine):
                 else:
                     self.commit_string (sp_res[1])
                 #self.add_string_len(sp_res[1])
-                self.db.check_phrase (sp_res[1], sp_res[2])
+                self.check_phrase (sp_res[1], sp_res[2])
             else:
                 if sp_res[1] == u' ':
                     self.commit_string (cond_letter_translate (u" "))
@@ -1789,7 +1930,7 @@ class EngineTable(IBus.Engine):
                 if sp_res[0]:
                     self.commit_string (sp_res[1])
                     #self.add_string_len(sp_res[1])
-                    self.db.check_phrase (sp_res[1],sp_res[2])
+                    self.check_phrase (sp_res[1],sp_res[2])
 
             res = self._editor.add_input( keychar )
             if not res:
@@ -1802,7 +1943,7 @@ class EngineTable(IBus.Engine):
                 if sp_res[0]:
                     self.commit_string (sp_res[1] + key_char)
                     #self.add_string_len(sp_res[1])
-                    self.db.check_phrase (sp_res[1],sp_res[2])
+                    self.check_phrase (sp_res[1],sp_res[2])
                     return True
                 else:
                     self.commit_string ( key_char )
@@ -1817,7 +1958,7 @@ class EngineTable(IBus.Engine):
                     if sp_res[0]:
                         self.commit_string (sp_res[1])
                         #self.add_string_len(sp_res[1])
-                        self.db.check_phrase (sp_res[1], sp_res[2])
+                        self.check_phrase (sp_res[1], sp_res[2])
                         return True
             self._update_ui ()
             return True
@@ -1846,7 +1987,7 @@ class EngineTable(IBus.Engine):
                     self._refresh_properties ()
                     self._update_ui ()
                 # modify freq info
-                self.db.check_phrase (commit_string, input_keys)
+                self.check_phrase (commit_string, input_keys)
             return True
 
         elif key.code <= 127:
@@ -1929,6 +2070,25 @@ class EngineTable(IBus.Engine):
                 self._full_width_letter[0] = value
             elif name == u'EnDefFullWidthPunct':
                 self._full_width_punct[0] = value
+            elif name == u'LearnDelay':
+                self._learn_delay = value
+            elif name == u'SyncDirtyRows':
+                self._sync_dirty_rows = value
+            elif name == u'UserDBMaxRows':
+                self._usrdb_max_rows = value
+            elif name == u'UserDBHalfLife':
+                self._usrdb_half_life = value
+            elif name == u'SyncInterval':
+                self._sync_interval = value
+                if self._sync_source:
+                    GLib.source_remove(self._sync_source)
+                    self._sync_source = None
+                if value > 0:
+                    self._sync_source = GLib.timeout_add_seconds(
+                        value, self._sync_usrdb_cb)
+            elif name == u'LazyLookupTable':
+                self._editor._lazy_lookup_table = value
+                self._editor.fill_lookup_table()
             elif name == u'LookupTableOrientation':
                 self._editor._lookup_table.set_orientation (value)
             elif name == u'LookupTableSelectKeys':
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# vim:et sts=4 sw=4
+#
+# ibus-table - The Tables engine for IBus
+#
+# Copyright (c) 2008-2013 Yuwei Yu <acevery@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+#
+# $Id: $
+#
+
+# Read only binary image of main.phrases, which is mmaped by every
+# engine process, so that they share the same physical pages.
+#
+# The layout of the file is:
+#   header:  magic, version, max_key_length, flags, row count,
+#            offset of string pool, crc32 of everything after header
+#   levels:  (first row, row count, offset of keys) for each key length
+#            from 1 to max_key_length
+#   records: (id, freq, user_freq, phrase offset, phrase length, clen,
+#            category) for each row
+#   keys:    tabkey ids of each row, one byte per key, rows of the same
+#            key length are packed together
+#   pool:    utf-8 encoded phrases
+# rows are sorted by mlen, tabkeys, user_freq DESC, freq DESC, id ASC.
+
+import os
+import mmap
+import struct
+import zlib
+
+MAGIC = 'IBTB'
+VERSION = 1
+
+_header = struct.Struct('<4sIIIIII')
+_level = struct.Struct('<III')
+_record = struct.Struct('<IiiIIHB')
+
+# flags in header
+FLAG_CHINESE = 1
+
+
+def image_name(db_name):
+    '''Return the file name of the binary image of db_name'''
+    return os.path.splitext(db_name)[0] + '.bin'
+
+
+def write_image(db, filename):
+    '''Write main.phrases of tabsqlitedb db into filename,
+    return the crc32 of the image
+    '''
+    mlen = db._mlen
+    sqlstr = ('SELECT %s FROM main.phrases ORDER BY mlen ASC, %s'
+              'user_freq DESC, freq DESC, id ASC;') % (
+                  db._pt_columns,
+                  ''.join(map(lambda x: 'm%d, ' % x, range(mlen))))
+    levels = [[0, 0, 0] for i in range(mlen)]
+    records = []
+    keys = []
+    pool = []
+    pool_len = 0
+    key_len = 0
+    nrows = 0
+    for row in db.db.execute(sqlstr):
+        _mlen = row[1]
+        if not levels[_mlen - 1][1]:
+            levels[_mlen - 1] = [nrows, 0, key_len]
+        levels[_mlen - 1][1] += 1
+        phrase = row[-3].encode('utf8')
+        category = row[-4] if db._is_chinese else 0
+        records.append(_record.pack(row[0], row[-2], row[-1], pool_len,
+                                    len(phrase), row[2], category))
+        keys.append(''.join(map(chr, row[3:3+_mlen])))
+        key_len += _mlen
+        pool.append(phrase)
+        pool_len += len(phrase)
+        nrows += 1
+    levels_off = _header.size
+    records_off = levels_off + _level.size * mlen
+    keys_off = records_off + _record.size * nrows
+    pool_off = keys_off + key_len
+    for level in levels:
+        level[2] += keys_off
+    body = ''.join(map(lambda x: _level.pack(*x), levels)
+                   + records + keys + pool)
+    checksum = zlib.crc32(body) & 0xffffffff
+    flags = FLAG_CHINESE if db._is_chinese else 0
+    f = open(filename, 'wb')
+    f.write(_header.pack(MAGIC, VERSION, mlen, flags, nrows,
+                         pool_off, checksum))
+    f.write(body)
+    f.close()
+    return checksum
+
+
+class tabmmap(object):
+    '''mmaped binary image of main.phrases'''
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        try:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        (magic, version, self._mlen, flags, self._nrows, self._pool_off,
+         self.checksum) = _header.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self._buf.close()
+            raise ValueError('%s is not a phrase image' % filename)
+        self._is_chinese = bool(flags & FLAG_CHINESE)
+        self._records_off = _header.size + _level.size * self._mlen
+        # (first row, row count, offset of keys) indexed by key length
+        self._levels = [None]
+        for i in range(self._mlen):
+            self._levels.append(
+                _level.unpack_from(self._buf, _header.size + _level.size * i))
+
+    def close(self):
+        self._buf.close()
+
+    def has_level(self, mlen):
+        '''Whether we have any phrase with mlen keys'''
+        return 0 < mlen <= self._mlen and self._levels[mlen][1] > 0
+
+    def select(self, mlen, tabkey_ids):
+        '''Return the rows with mlen keys starting with tabkey_ids,
+        in the same form as select_words_sql
+        '''
+        if not self.has_level(mlen):
+            return []
+        first, count, key_off = self._levels[mlen]
+        _len = len(tabkey_ids)
+        prefix = ''.join(map(chr, tabkey_ids))
+        buf = self._buf
+        # lower bound
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            off = key_off + mid * mlen
+            if buf[off:off+_len] < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+        # upper bound
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            off = key_off + mid * mlen
+            if buf[off:off+_len] > prefix:
+                hi = mid
+            else:
+                lo = mid + 1
+        return map(lambda x: self.row(mlen, first + x, key_off + x * mlen),
+                   xrange(start, lo))
+
+    def row(self, mlen, index, key_off):
+        '''Unpack the row at index, whose keys are at key_off'''
+        (_id, freq, user_freq, phrase_off, phrase_len,
+         clen, category) = _record.unpack_from(
+             self._buf, self._records_off + _record.size * index)
+        row = (_id, mlen, clen) + struct.unpack_from(
+            '%dB' % mlen, self._buf, key_off) + (None,) * (self._mlen - mlen)
+        if self._is_chinese:
+            row += (category,)
+        phrase_off += self._pool_off
+        return row + (self._buf[phrase_off:phrase_off+phrase_len].decode(
+            'utf8'), freq, user_freq)
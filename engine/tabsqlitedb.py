@@ -24,23 +24,419 @@
 
 import os
 import os.path as path
+import sys
 from sys import stderr
 import sqlite3
 import tabdict
+import tabmmap
+import tabjournal
 import uuid
 import time
 import re
+from bisect import bisect_left, insort
+import heapq
+import itertools
+import threading
+from collections import OrderedDict, deque
 
 patt_r = re.compile(r'c([ea])(\d):(.*)')
 patt_p = re.compile(r'p(-{0,1}\d)(-{0,1}\d)')
 
+# sqlite3 keeps this many prepared statements per connection, it is
+# large enough for every statement sqlstr() builds for tables with up to
+# about 16 keys, the default 100 is thrashed by select_words.
+statement_cache_size = 1024
+
+# seconds a statement waits for the user database while the engine of
+# another table writes it, see sync_usrdb
+busy_timeout = 10.0
+
 # first make some number index we will used :)
 #(MLEN, CLEN, M0, M1, M2, M3, M4, PHRASE, FREQ, USER_FREQ) = range (0,10)
 
 
+# ChineseMode 2 and 3 show all candidates, grouped by category. Every
+# group is (bits the category must have, bits it must not have).
+chinese_mode_groups = {
+    # big charset with SC first
+    2: ((1, 0), (1 << 1, 1), (1 << 2, 0)),
+    # big charset with TC first
+    3: ((1 << 1, 0), (1, 1 << 1), (1 << 2, 0)),
+}
+
+
+def ime_defaults(name):
+    '''Return the default attributes of main.ime of the database file
+    name, as a dict'''
+    return {'name':'',
+            'name.zh_cn':'',
+            'name.zh_hk':'',
+            'name.zh_tw':'',
+            'author':'somebody',
+            # derived from the name, so that the same sources
+            # give the same database
+            'uuid':'%s' % uuid.uuid5(
+                uuid.NAMESPACE_URL, 'ibus-table:%s'
+                % path.basename(name)),
+            # ibus-table-createdb sets its own, see serial_number
+            'serial_number':'%s' % time.strftime('%Y%m%d'),
+            'icon':'ibus-table.svg',
+            'license':'LGPL',
+            'languages':'',
+            'valid_input_chars':'abcdefghijklmnopqrstuvwxyz',
+            'max_key_length':'4',
+    #        'commit_keys':'space',
+    #        'forward_keys':'Return',
+    #        'select_keys':'1,2,3,4,5,6,7,8,9,0',
+    #        'page_up_keys':'Page_Up,minus',
+    #        'page_down_keys':'Page_Down,equal',
+            'status_prompt':'',
+            'def_full_width_punct':'TRUE',
+            'def_full_width_letter':'FALSE',
+            'user_can_define_phrase':'FALSE',
+            'pinyin_mode':'FALSE',
+            'dynamic_adjust':'FALSE',
+            'auto_commit':'false',
+            'auto_select':'false',
+            #'no_check_chars':u'',
+            'description':'A IME under IBus Table',
+            'layout':'us',
+            'rules':'',
+            #'rules':'ce2:p11+p12+p21+p22; \
+            # ce3:p11+p21+p22+p31;ca4:p11+p21+p31+p41'
+            'least_commit_length':'0',
+            'start_chars':''
+            # we use this entry for those IME, which don't
+            # have rules to build up phrase, but still need
+            # auto commit to preedit
+            }
+
+
+def group_candidates(candidates, mode, category):
+    '''Group candidates for ChineseMode mode in one pass, category is
+    the index of the category column'''
+    groups = chinese_mode_groups[mode]
+    buckets = map(lambda x: [], groups)
+    for x in candidates:
+        for (need, without), bucket in zip(groups, buckets):
+            if x[category] & need and not x[category] & without:
+                bucket.append(x)
+    return sum(buckets, [])
+
+
+# the CJK ideographs as (first, last) code points, the category of a
+# phrase only depends on them
+han_ranges = ((0x4E00, 0x9FCB),
+              (0x3400, 0x4DB5),
+              (0xF900, 0xFAFF),
+              (0x20000, 0x2A6D6),
+              (0x2A700, 0x2B734),
+              (0x2B740, 0x2B81D),
+              (0x2F800, 0x2FA1D))
+
+# the charsets of a CJK ideograph, 7 for any other character so that
+# it does not count when they are and-ed over a phrase
+CHARSET_GB2312 = 1
+CHARSET_BIG5HKSCS = 1 << 1
+CHARSET_GBK = 1 << 2
+
+_charset_table = None
+
+
+def charset_table():
+    '''Return the charsets of every code point up to the last CJK
+    ideograph as a bytearray, it is generated once, when a chinese table
+    is opened or before the builder forks its workers'''
+    global _charset_table
+    if _charset_table is None:
+        table = bytearray(chr(7)) * (max(map(lambda x: x[1], han_ranges)) + 1)
+        charsets = ((CHARSET_GB2312, 'gb2312'),
+                    (CHARSET_BIG5HKSCS, 'big5hkscs'),
+                    (CHARSET_GBK, 'gbk'))
+        for first, last in han_ranges:
+            for code in xrange(first, last + 1):
+                char = unichr(code)
+                table[code] = 0
+                for bit, codec in charsets:
+                    try:
+                        char.encode(codec)
+                        table[code] |= bit
+                    except UnicodeError:
+                        pass
+        _charset_table = table
+    return _charset_table
+
+
+def _category_of_charsets(charsets):
+    # this is the bitmask we will use,
+    # from low to high, 1st bit is simplify Chinese,
+    # 2nd bit is traditional Chinese,
+    # 3rd bit means out of gbk
+    category = 0
+    # first whether in gb2312
+    if charsets & CHARSET_GB2312:
+        category |= 1
+    # second check big5-hkscs
+    if charsets & CHARSET_BIG5HKSCS:
+        category |= 1 << 1
+    # then check whether in gbk
+    elif charsets & CHARSET_GBK:
+        category |= 1
+    # then set for 3rd bit, if not in SC and TC
+    if not (category & (1 | 1 << 1)):
+        category |= (1 << 2)
+    return category
+
+# category of the charsets all the CJK ideographs of a phrase are in
+_categories = tuple(map(_category_of_charsets, range(8)))
+
+
+def phrase_category(phrase):
+    '''Return the category bits of the unicode phrase'''
+    table = charset_table()
+    size = len(table)
+    charsets = 7
+    for char in phrase:
+        code = ord(char)
+        if code < size:
+            charsets &= table[code]
+    return _categories[charsets]
+
+
+def classify_phrases(phrases):
+    '''Return phrases, a list of (tabkeys, phrase, freq[, user_freq]),
+    with the category of each phrase, this runs in the worker processes
+    of bulk_add_phrases'''
+    return phrases, map(lambda x: phrase_category(
+        x[1] if type(x[1]) == type(u'') else x[1].decode('utf8')), phrases)
+
+
+def classify_chunks(chunks, pool, window):
+    '''Yield the chunks classified by pool like classify_phrases, in
+    order. We read chunks here, so that its errors reach the caller,
+    and keep at most window of them in the pool, so that they do not
+    pile up while the caller inserts them'''
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(classify_phrases, (chunk,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class prefix_result(object):
+    '''Candidates selected for a tabkey prefix.
+
+    If complete is True, rows hold every completion of the prefix, so
+    the candidates of a longer prefix can be filtered from them instead
+    of doing another sql enquiry.
+    '''
+    def __init__(self, tabkey_ids, onechar, bitmask, rows, complete):
+        self.tabkey_ids = tuple(tabkey_ids)
+        self.onechar = onechar
+        self.bitmask = bitmask
+        self.rows = rows
+        self.complete = complete
+        # same as select_words_sql, we only show the shortest completions
+        # and the ones with one key more
+        _len = len(self.tabkey_ids)
+        if rows:
+            bound = max(_len + 1, rows[0][1])
+            self.candidates = filter(lambda x: x[1] <= bound, rows)
+        else:
+            self.candidates = []
+        # candidates grouped for ChineseMode 2 and 3, see grouped
+        self._grouped = {}
+
+    def matches(self, tabkey_ids, onechar, bitmask):
+        '''Whether our prefix is a prefix of tabkey_ids,
+        selected with the same options'''
+        _len = len(self.tabkey_ids)
+        return (tuple(tabkey_ids[:_len]) == self.tabkey_ids
+                and onechar == self.onechar and bitmask == self.bitmask)
+
+    def grouped(self, mode, category):
+        '''Return candidates in the order of ChineseMode mode, the
+        grouping is done once per result'''
+        if mode not in chinese_mode_groups:
+            return self.candidates
+        if mode not in self._grouped:
+            self._grouped[mode] = group_candidates(self.candidates, mode,
+                                                   category)
+        return self._grouped[mode]
+
+    def narrow(self, tabkey_ids):
+        '''Return the prefix_result of a longer prefix from our rows'''
+        _ids = tuple(tabkey_ids)
+        _len = len(_ids)
+        return prefix_result(_ids, self.onechar, self.bitmask,
+                             filter(lambda x: x[3:3+_len] == _ids, self.rows),
+                             self.complete)
+
+
+class candidate_cache(object):
+    '''Bounded LRU cache of prefix_result keyed by
+    (tabkey ids, onechar, bitmask)
+
+    The cache holds at most max_entries results and about max_bytes of
+    rows, hits and misses count the lookups so that we can size it.
+    '''
+    def __init__(self, max_entries=256, max_bytes=4*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        # key -> (prefix_result, size)
+        self._entries = OrderedDict()
+        # tabkey ids -> set of keys, for invalidate()
+        self._prefixes = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, tabkey_ids, onechar, bitmask):
+        '''Return the cached prefix_result or None'''
+        key = (tuple(tabkey_ids), onechar, bitmask)
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # move it to the most recently used end
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, result):
+        '''Add a prefix_result, evict the least recently used ones
+        if we are over budget'''
+        key = (result.tabkey_ids, result.onechar, result.bitmask)
+        self.discard(key)
+        size = (sys.getsizeof(result.rows) + sys.getsizeof(result.candidates)
+                + sum(map(lambda x: sys.getsizeof(x) + sys.getsizeof(x[-3]),
+                          result.rows)))
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        self._entries[key] = (result, size)
+        self._prefixes.setdefault(key[0], set()).add(key)
+        self.bytes += size
+        while (len(self._entries) > self.max_entries
+               or self.bytes > self.max_bytes):
+            self.discard(next(iter(self._entries)))
+
+    def discard(self, key):
+        '''Remove the result of key if we have it'''
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.bytes -= entry[1]
+            keys = self._prefixes[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self._prefixes[key[0]]
+
+    def invalidate(self, tabkey_ids):
+        '''Evict the results of every prefix of tabkey_ids, which are
+        the only ones a phrase with code tabkey_ids can show up in'''
+        _ids = tuple(tabkey_ids)
+        for i in xrange(1, len(_ids) + 1):
+            for key in list(self._prefixes.get(_ids[:i], ())):
+                self.discard(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._prefixes.clear()
+        self.bytes = 0
+
+    def stats(self):
+        '''Return a dict of entries, bytes, hits and misses'''
+        return {'entries': len(self._entries), 'bytes': self.bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class phrase_overlay(object):
+    '''In memory copy of user_db.phrases, and of the phrases learned in
+    this session, which we call mudb. select_words and check_phrase only
+    query main.phrases and take the user phrases from here.
+
+    Rows are in the form of main.phrases rows, in each database they are
+    keyed by row[1:-2], i.e. (mlen, clen, m0, ..., [category], phrase).
+    '''
+    def __init__(self):
+        self._rows = {'user_db': {}, 'mudb': {}}
+        self._last_id = {'user_db': 0, 'mudb': 0}
+        # sorted (tabkey ids, database, key), for prefix lookup
+        self._codes = []
+        # phrase -> set of (database, key)
+        self._phrases = {}
+
+    def __len__(self):
+        return len(self._codes)
+
+    def rows(self, database):
+        '''Return the dict of rows of database'''
+        return self._rows[database]
+
+    def next_id(self, database):
+        return self._last_id[database] + 1
+
+    def add(self, database, row):
+        '''Add row to database, replace the row of the same key'''
+        key = row[1:-2]
+        self.remove(database, key)
+        self._rows[database][key] = row
+        self._last_id[database] = max(self._last_id[database], row[0])
+        insort(self._codes, (row[3:3+row[1]], database, key))
+        self._phrases.setdefault(row[-3], set()).add((database, key))
+
+    def remove(self, database, key):
+        '''Remove the row of key from database, return it'''
+        row = self._rows[database].pop(key, None)
+        if row is None:
+            return None
+        del self._codes[bisect_left(self._codes,
+                                    (row[3:3+row[1]], database, key))]
+        self._phrases[row[-3]].discard((database, key))
+        if not self._phrases[row[-3]]:
+            del self._phrases[row[-3]]
+        return row
+
+    def set_user_freq(self, database, key, user_freq):
+        row = self._rows[database].get(key)
+        if row is not None:
+            self._rows[database][key] = row[:-1] + (user_freq,)
+
+    def select(self, tabkey_ids, bound, onechar=False, bitmask=0,
+               category=0):
+        '''Return the rows starting with tabkey_ids, with mlen <= bound,
+        filtered like select_words'''
+        prefix = tuple(tabkey_ids)
+        upper = prefix[:-1] + (prefix[-1] + 1,)
+        result = []
+        for code, database, key in self._codes[
+                bisect_left(self._codes, (prefix,)):
+                bisect_left(self._codes, (upper,))]:
+            row = self._rows[database][key]
+            if (row[1] <= bound and not (onechar and row[2] != 1)
+                    and not (bitmask and not row[category] & bitmask)):
+                result.append(row)
+        return result
+
+    def select_phrase(self, phrase, tabkey_ids=()):
+        '''Return the rows of phrase, whose keys start with tabkey_ids'''
+        _ids = tuple(tabkey_ids)
+        _len = len(_ids)
+        return [self._rows[database][key]
+                for database, key in self._phrases.get(phrase, ())
+                if self._rows[database][key][3:3+_len] == _ids]
+
+
 class tabsqlitedb:
     '''Phrase database for tables'''
-    def __init__(self, name='table.db', user_db=None, filename=None):
+    def __init__(self, name='table.db', user_db=None, filename=None,
+                 prefix_index=False, cache_entries=256,
+                 cache_bytes=4*1024*1024):
         # use filename when you are creating db from source use name
         # when you are using db first we use the Parse in tabdict,
         # which transform the char(a,b,c,...) to int(1,2,3,...) to
@@ -48,19 +444,20 @@ class tabsqlitedb:
         self.parse = tabdict.parse
         self.deparse = tabdict.deparse
         self._add_phrase_sqlstr = ''
-        self.old_phrases=[]
+        # outdated user database renamed away, see migrate_user_db
+        self.old_user_db = None
         self.ime_property_cache = {}
 
+        # sql statements built by sqlstr(), see the _sqlstr_* methods
+        self._sqlstrs = {}
         if filename:
             # now we are creating db
-            self.db = sqlite3.connect(filename)
+            self.db = sqlite3.connect(filename,
+                                      cached_statements=statement_cache_size)
         else:
-            try:
-                os.system('cat %s > /dev/null' % name)
-            except:
-                pass
             # open system phrase db
-            self.db = sqlite3.connect(name)
+            self.db = sqlite3.connect(name, timeout=busy_timeout,
+                                      cached_statements=statement_cache_size)
         try:
             self.db.execute('PRAGMA page_size = 8192; ')
             self.db.execute('PRAGMA cache_size = 20000; ')
@@ -78,52 +475,19 @@ class tabsqlitedb:
         if not self.db.execute(
                 'SELECT val FROM main.ime WHERE attr="name";'
         ).fetchall():
-            ime_keys={'name':'',
-                      'name.zh_cn':'',
-                      'name.zh_hk':'',
-                      'name.zh_tw':'',
-                      'author':'somebody',
-                      'uuid':'%s' % uuid.uuid4(),
-                      'serial_number':'%s' % time.strftime('%Y%m%d'),
-                      'icon':'ibus-table.svg',
-                      'license':'LGPL',
-                      'languages':'',
-                      'valid_input_chars':'abcdefghijklmnopqrstuvwxyz',
-                      'max_key_length':'4',
-            #          'commit_keys':'space',
-            #          'forward_keys':'Return',
-            #          'select_keys':'1,2,3,4,5,6,7,8,9,0',
-            #          'page_up_keys':'Page_Up,minus',
-            #          'page_down_keys':'Page_Down,equal',
-                      'status_prompt':'',
-                      'def_full_width_punct':'TRUE',
-                      'def_full_width_letter':'FALSE',
-                      'user_can_define_phrase':'FALSE',
-                      'pinyin_mode':'FALSE',
-                      'dynamic_adjust':'FALSE',
-                      'auto_commit':'false',
-                      'auto_select':'false',
-                      #'no_check_chars':u'',
-                      'description':'A IME under IBus Table',
-                      'layout':'us',
-                      'rules':'',
-                      #'rules':'ce2:p11+p12+p21+p22; \
-                      # ce3:p11+p21+p22+p31;ca4:p11+p21+p31+p41'
-                      'least_commit_length':'0',
-                      'start_chars':''
-                      # we use this entry for those IME, which don't
-                      # have rules to build up phrase, but still need
-                      # auto commit to preedit
-                      }
+            ime_keys = ime_defaults(filename or name)
             # inital the attribute in ime table,
             # which should be updated from mabiao
-            for _name in ime_keys:
+            for _name in sorted(ime_keys):
                 sqlstr = 'INSERT INTO main.ime (attr,val) VALUES (?,?);'
                 self.db.execute(sqlstr, (_name,ime_keys[_name]))
         # share variables in this class:
         self._mlen = int(self.get_ime_property("max_key_length"))
         # for chinese
         self._is_chinese = self.is_chinese()
+        if self._is_chinese:
+            # not at the first phrase we classify
+            charset_table()
         # for fast add word
         self._set_add_phrase_sqlstr()
         #(ID, MLEN, CLEN, M0, M1, M2, M3, M4,
@@ -134,6 +498,9 @@ class tabsqlitedb:
         if self._is_chinese:
             self._pt_index += ['category']
         self._pt_index += ['phrase','freq','user_freq']
+        # we select these columns instead of *, so that rows do not
+        # contain the packed code column
+        self._pt_columns = ', '.join(self._pt_index)
         self.user_can_define_phrase = self.get_ime_property(
             'user_can_define_phrase'
         )
@@ -164,12 +531,55 @@ class tabsqlitedb:
         self.startchars = self.get_start_chars()
 
         #self._no_check_chars = self.get_no_check_chars()
+        # select all completions of prefixes of this length or longer,
+        # see select_prefix
+        self.complete_prefix_len = 2
+        # phrases committed by user but not learned yet, see queue_phrase
+        self._learn_queue = []
+        # user_db and mudb phrases, see phrase_overlay
+        self.overlay = phrase_overlay()
+        # keys (row[1:-2]) of mudb rows changed since the last sync_usrdb,
+        # and the user_freq user_db had for them when this process last
+        # wrote them, see sync_usrdb
+        self._mudb_dirty = set()
+        self._mudb_base = {}
+        # journal of the mudb changes, see open_journal
+        self.journal = None
+        self._stale_journals = []
+        # LRU cache of select_prefix results
+        self.candidate_cache = candidate_cache(cache_entries, cache_bytes)
         # for fast gouci
         self._goucima = {}
+        # in memory prefix index of main.phrases, see build_prefix_index()
+        self._prefix_index = {}
+        # mmaped image of main.phrases, see tabmmap
+        self._phrase_image = None
+        # prefixes up to this length are answered from main.top_phrases,
+        # see build_top_phrases
+        self._top_prefix_len = 0
+        # whether an engine has scheduled compact_usrdb, the engines of
+        # a process share this db and it is compacted only once
+        self.compact_scheduled = False
         if filename:
             # since we just creating db, we do not need userdb and mudb
+            self._main_has_code = True
             return
 
+        # databases created by older ibus-table-createdb do not have
+        # the packed code column
+        self._main_has_code = self.has_code_column('main')
+        if self._main_has_code and self.get_ime_property('top_prefix_len'):
+            self._top_prefix_len = int(
+                self.get_ime_property('top_prefix_len'))
+
+        self._phrase_image = self.open_phrase_image(name)
+        if not self._phrase_image:
+            # no image, warm up the page cache for the system phrases
+            try:
+                os.system('cat %s > /dev/null' % name)
+            except:
+                pass
+
         # user database:
         if user_db != None:
             home_path = os.getenv("HOME")
@@ -181,22 +591,12 @@ class tabsqlitedb:
                 desc = self.get_database_desc(user_db)
                 if desc == None:
                     self.init_user_db(user_db)
-                elif desc["version"] != "0.5":
-                    new_name = "%s.%d" % (user_db, os.getpid())
-                    print >> stderr, ' '.join(
-                        ['Can not support the user db.',
-                         'We will rename it to %s' % new_name]
-                    )
-                    self.old_phrases = self.extra_user_phrases(user_db)
-                    os.rename(user_db, new_name)
-                    self.init_user_db(user_db)
-                elif self.get_table_phrase_len(user_db) != len(self._pt_index):
-                    print >> stderr, "user db format outdated."
-                    # store old user phrases
-                    self.old_phrases = self.extra_user_phrases(user_db)
-                    new_name = "%s.%d" % (user_db, os.getpid())
-                    os.rename(user_db, new_name)
-                    self.init_user_db(user_db)
+                else:
+                    # we migrate the old user phrases below
+                    self.old_user_db = self.rename_outdated_user_db(
+                        user_db, desc)
+                    if self.old_user_db:
+                        self.init_user_db(user_db)
             except:
                 import traceback
                 traceback.print_exc()
@@ -212,64 +612,280 @@ class tabsqlitedb:
             os.rename(user_db, "%s.%d" % (user_db, os.getpid()))
             self.init_user_db(user_db)
             self.db.execute('ATTACH DATABASE "%s" AS user_db;' % user_db)
+        # sync_usrdb writes small transactions during the session, and
+        # the engines of other tables may read and write the same file,
+        # WAL keeps them cheap and lets readers go on while one writes
+        try:
+            self.db.execute('PRAGMA user_db.journal_mode = WAL;')
+            self.db.execute('PRAGMA user_db.synchronous = NORMAL;')
+        except:
+            pass
         self.create_tables("user_db")
-        if self.old_phrases:
-            # (mlen, phrase, freq, user_freq)
-            # the phrases will be deparse again, and then be added
-            # the characters will be discard :(
-            #chars = filter (lambda x: x[0] == 1, self.old_phrases)
-            # print chars
-            phrases = filter(lambda x: x[0] > 1, self.old_phrases)
-            phrases = map(lambda x: [self.parse_phrase_to_tabkeys(x[1])] +
-                          list(x[1:]), phrases)
-
-            map(self.u_add_phrase,phrases)
-            self.db.commit ()
+        if not self.has_code_column("user_db"):
+            # user db from older version, we just need to add the column
+            self.add_code_column("user_db")
+        # keys sync_usrdb looks up in user_db, see missing_rows. It is
+        # created here, creating it later commits the open transaction
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS sync_keys '
+                        '(idx INTEGER, %s);' % ', '.join(self._pt_index[1:-2]))
+        if self.old_user_db:
+            self.migrate_user_db(self.old_user_db)
+        map(lambda x: self.overlay.add('user_db', x), self.db.execute(
+            'SELECT %s FROM user_db.phrases ORDER BY id;' % self._pt_columns))
 
 
         # try create all tables in user database
         self.create_indexes("user_db",commit=False)
         self.generate_userdb_desc()
 
-        # attach mudb for working process
-        mudb = ":memory:"
-        self.db.execute('ATTACH DATABASE "%s" AS mudb;' % mudb)
-        self.create_tables("mudb")
+        # mudb of working process lives in self.overlay only, and in
+        # a journal file until sync_usrdb writes it into user_db
+        if user_db != ":memory:":
+            self.open_journal(user_db)
+        if prefix_index:
+            self.build_prefix_index()
 
     def update_phrase(self, entry, database='user_db'):
         '''update phrase freqs'''
         #print entry
         _con = [entry[-1]] + list(entry[1:3+entry[1]]) + [entry[-3]]
         #print _con
-        _condition = u''.join(
-            map(lambda x: 'AND m%d = ? ' % x, range(entry[1]))
-        )
-        #print _condition
-        sqlstr = ('UPDATE %s.phrases SET user_freq = ? '
-                  'WHERE mlen = ? AND clen = ? '
-                  '%s AND phrase = ?;') % (database, _condition)
+        sqlstr = self.sqlstr('update_phrase', database, entry[1])
         #print sqlstr
         self.db.execute(sqlstr , _con)
+        if database == 'user_db':
+            self.overlay.set_user_freq(database, tuple(entry[1:-2]),
+                                       entry[-1])
+        self.candidate_cache.invalidate(entry[3:3+entry[1]])
         # because we may update different db, we'd better commit every time.
         self.db.commit()
 
     def sync_usrdb(self):
-        # we need to update the user_db
-        #print 'sync userdb'
-        mudata = self.db.execute('SELECT * FROM mudb.phrases;').fetchall()
-        #print mudata
-        data_u = filter(lambda x: x[-2] in [1,-3], mudata)
-        data_a = filter(lambda x: x[-2]==2, mudata)
-        data_n = filter(lambda x: x[-2]==-2, mudata)
-        #print data_a
-        data_a = map(lambda x: (u''.join(map(self.deparse, x[3:3+x[1]])),x[-3],0,x[-1]), data_a)
-        data_n = map(lambda x: (u''.join(map(self.deparse, x[3:3+x[1]])),x[-3],-1,x[-1]), data_n)
-        #print data_u
-        map(self.update_phrase, data_u)
-        #print self.db.execute('select * from user_db.phrases;').fetchall()
-        map(self.u_add_phrase, data_a)
-        map(self.u_add_phrase, data_n)
-        self.db.commit ()
+        '''Write the mudb rows changed since last time into user_db in
+        one transaction, return how many rows we wrote.
+
+        Other engine processes may have changed user_db meanwhile, so we
+        add what this process has learned to the user_freq in user_db
+        instead of overwriting it, and insert the rows it does not have.
+        '''
+        self.learn_phrases()
+        if not self._mudb_dirty:
+            self.checkpoint_journal()
+            return 0
+        mudb = self.overlay.rows('mudb')
+        usrdb = self.overlay.rows('user_db')
+        mudata = map(mudb.get, filter(lambda x: x in mudb, self._mudb_dirty))
+        base = self._mudb_base
+        delta = lambda x: x[-1] - base.get(x[1:-2], 0)
+        data_u = filter(lambda x: x[1:-2] in usrdb, mudata)
+        data_n = filter(lambda x: x[1:-2] not in usrdb, mudata)
+        deltas = lambda rows: map(lambda x: x[:-1] + (delta(x),), rows)
+        self.bulk_update_user_freq(deltas(data_u), 'user_db', delta=True,
+                                   commit=False)
+        # removed by another process, we add them back below. The updated
+        # row count does not tell, user_db may hold duplicates of a key
+        gone = self.missing_rows(data_u)
+        map(lambda x: self.overlay.remove('user_db', x[1:-2]), gone)
+        data_n += gone
+        # rows new to this process, another one may have added them
+        if data_n and self.bulk_update_user_freq(
+                deltas(data_n), 'user_db', delta=True, commit=False):
+            data_n = self.missing_rows(data_n)
+        # -2 and -3 are user defined phrases in mudb
+        self.bulk_add_phrases(map(lambda x: (
+            u''.join(map(self.deparse, x[3:3+x[1]])), x[-3],
+            -1 if x[-2] in (-2, -3) else 0, x[-1]), data_n),
+                              'user_db', commit=False)
+        self.checkpoint_journal()
+        map(lambda x: base.update({x[1:-2]: x[-1]}), mudata)
+        self._mudb_dirty.clear()
+        return len(mudata)
+
+    def missing_rows(self, rows, database='user_db'):
+        '''Return the rows whose keys (row[1:-2]) are not in database, we
+        look them up through temp.sync_keys with one query for each key
+        length'''
+        if not rows:
+            return []
+        self.db.execute('DELETE FROM temp.sync_keys;')
+        self.db.executemany(self.sqlstr('add_sync_key'), map(
+            lambda i, x: (i,) + tuple(x[1:-2]), range(len(rows)), rows))
+        missing = []
+        for _mlen in set(map(lambda x: x[1], rows)):
+            missing += map(lambda x: x[0], self.db.execute(
+                self.sqlstr('missing_keys', database, _mlen)))
+        return map(lambda x: rows[x], sorted(missing))
+
+    def open_journal(self, user_db):
+        '''Replay the journals of user_db left by the engines which
+        crashed before their sync_usrdb, and start ours'''
+        orphans = tabjournal.claim_orphans(user_db)
+        self.journal = tabjournal.tabjournal(user_db)
+        for filename, token in orphans:
+            # the part before this offset is in user_db already
+            offset = self.get_userdb_desc('journal-' + token)
+            map(lambda x: self.replay_journal_record(*x),
+                tabjournal.read_records(filename, int(offset or 0)))
+            # the records are in our journal now
+            self.journal.flush()
+            os.unlink(filename)
+        tokens = tabjournal.tokens(user_db)
+        self._stale_journals = filter(lambda x: x not in tokens, map(
+            lambda x: x[0][len('journal-'):], self.db.execute(
+                'SELECT name FROM user_db.desc '
+                'WHERE name LIKE "journal-%";').fetchall()))
+        if orphans:
+            print >> stderr, 'replayed %d learned phrases' % len(
+                self._mudb_dirty)
+
+    def journal_mudb(self, key, freq, user_freq, commit=True):
+        '''Add the change of the mudb row of key to our journal, call it
+        before the change'''
+        if not self.journal:
+            return
+        row = self.overlay.rows('mudb').get(key)
+        self.journal.append(freq, key[2:2+key[0]],
+                            key[-2] if self._is_chinese else 0, key[-1],
+                            user_freq - (row[-1] if row
+                                         else self._mudb_base.get(key, 0)))
+        if commit:
+            self.journal.flush()
+
+    def set_mudb_user_freq(self, key, user_freq, commit=True):
+        row = self.overlay.rows('mudb').get(key)
+        if row is not None:
+            self.journal_mudb(key, row[-2], user_freq, commit)
+            self.overlay.set_user_freq('mudb', key, user_freq)
+
+    def replay_journal_record(self, freq, tabkey_ids, category, phrase,
+                              delta):
+        '''Apply a journal record to mudb, and add it to our journal'''
+        self.journal.append(freq, tabkey_ids, category, phrase, delta)
+        key = (len(tabkey_ids), len(phrase)) + tabkey_ids + (
+            (None,) * (self._mlen - len(tabkey_ids)))
+        if self._is_chinese:
+            key += (category,)
+        key += (phrase,)
+        self.candidate_cache.invalidate(tabkey_ids)
+        if not freq:
+            self.overlay.remove('mudb', key)
+            self._mudb_dirty.discard(key)
+            self._mudb_base.pop(key, None)
+            return
+        row = self.overlay.rows('mudb').get(key)
+        if row:
+            user_freq = row[-1] + delta
+        else:
+            row = self.overlay.rows('user_db').get(key)
+            self._mudb_base.setdefault(key, row[-1] if row else 0)
+            user_freq = self._mudb_base[key] + delta
+        self.overlay.add('mudb', (self.overlay.next_id('mudb'),) + key
+                         + (freq, user_freq))
+        self._mudb_dirty.add(key)
+
+    def checkpoint_journal(self):
+        '''Commit user_db with the length of our journal written into it,
+        then start a new journal'''
+        if not self.journal or self.journal.size <= len(tabjournal.MAGIC):
+            self.db.commit()
+            return
+        self.db.executemany('DELETE FROM user_db.desc WHERE name = ?;',
+                            map(lambda x: ('journal-' + x,),
+                                self._stale_journals))
+        self.db.execute('INSERT OR REPLACE INTO user_db.desc VALUES (?, ?);',
+                        ('journal-' + self.journal.token, self.journal.size))
+        self.db.commit()
+        # a crash from here on replays the journal from the end
+        self._stale_journals = [self.journal.token]
+        self.journal.rotate()
+
+    def dirty_phrases(self):
+        '''How many mudb rows sync_usrdb would write now'''
+        return len(self._mudb_dirty)
+
+    def compact_usrdb(self, max_rows=0, half_life=0):
+        '''Age and trim user_db, return how many rows we dropped.
+
+        The user_freq of the rows copying a system phrase (freq = 0) is
+        halved once every half_life days, the ones reaching 0 are dropped,
+        then the coldest of them are dropped until at most max_rows rows
+        are left. User defined phrases (freq = -1) and the phrases
+        learned in this session are always kept.
+        '''
+        self.sync_usrdb()
+        periods = 0
+        if half_life > 0:
+            now = time.time()
+            last = self.get_userdb_desc('decay-time')
+            if last == None:
+                self.set_userdb_desc('decay-time', now)
+            else:
+                periods = int((now - float(last)) // (half_life * 86400))
+                if periods > 0:
+                    self.set_userdb_desc(
+                        'decay-time', float(last) + periods*half_life*86400)
+                    periods = min(periods, 31)
+        rows = self.overlay.rows('user_db')
+        if not periods and not (0 < max_rows < len(rows)):
+            return 0
+        protected = self.overlay.rows('mudb')
+        cold = filter(lambda x: x[-2] == 0 and x[1:-2] not in protected,
+                      rows.values())
+        if periods:
+            self.db.execute('UPDATE user_db.phrases SET user_freq = '
+                            'user_freq >> ? WHERE freq = 0;', (periods,))
+            map(lambda x: self.overlay.set_user_freq(
+                'user_db', x[1:-2], x[-1] >> periods),
+                filter(lambda x: x[-2] == 0, rows.values()))
+            cold = map(lambda x: x[:-1] + (x[-1] >> periods,), cold)
+        # coldest and oldest first
+        cold.sort(key=lambda x: (x[-1], x[0]))
+        drop = len(filter(lambda x: x[-1] <= 0, cold))
+        if 0 < max_rows < len(rows) - drop:
+            drop = min(len(cold), len(rows) - max_rows)
+        cold = cold[:drop]
+        # by key, so that older duplicates of the row go as well
+        for _mlen in set(map(lambda x: x[1], cold)):
+            self.db.executemany(
+                self.sqlstr('delete_phrase', 'user_db', _mlen),
+                map(lambda x: filter(lambda y: y != None, x[1:-2]),
+                    filter(lambda x: x[1] == _mlen, cold)))
+        map(lambda x: self.overlay.remove('user_db', x[1:-2]), cold)
+        self.db.commit()
+        self.candidate_cache.clear()
+        if cold:
+            self.vacuum_usrdb()
+        return len(cold)
+
+    def vacuum_usrdb(self, min_free=0.25):
+        '''VACUUM user_db in a thread of its own if at least min_free of
+        its pages are free, return the thread, None if it is not worth it
+        '''
+        free = self.db.execute('PRAGMA user_db.freelist_count;').fetchall()
+        pages = self.db.execute('PRAGMA user_db.page_count;').fetchall()
+        if not pages[0][0] or free[0][0] < pages[0][0] * min_free:
+            return None
+        filename = filter(lambda x: x[1] == 'user_db', self.db.execute(
+            'PRAGMA database_list;').fetchall())[0][2]
+        if not filename:
+            return None
+
+        def vacuum():
+            # its own connection, so that the engine goes on meanwhile
+            try:
+                db = sqlite3.connect(filename, timeout=busy_timeout)
+                try:
+                    db.execute('VACUUM;')
+                finally:
+                    db.close()
+            except sqlite3.Error:
+                import traceback
+                traceback.print_exc()
+
+        thread = threading.Thread(target=vacuum)
+        thread.daemon = True
+        thread.start()
+        return thread
 
     def is_chinese(self):
         __lang = self.get_ime_property('languages')
@@ -325,10 +941,33 @@ class tabsqlitedb:
         sqlstr += ''.join(map(lambda x: 'm%d INTEGER, ' % x, range(self._mlen)))
         if self._is_chinese:
             sqlstr += 'category INTEGER, '
-        sqlstr += 'phrase TEXT, freq INTEGER, user_freq INTEGER);'
+        # code is the tabkey ids packed into a blob, which sorts like the
+        # m columns, so a prefix is a range of code
+        sqlstr += 'phrase TEXT, freq INTEGER, user_freq INTEGER, code BLOB);'
         self.db.execute(sqlstr)
         self.db.commit()
 
+    def has_code_column(self, database):
+        '''Whether phrases table in database has the packed code column'''
+        return 'code' in map(lambda x: x[1], self.db.execute(
+            'PRAGMA %s.table_info(phrases);' % database).fetchall())
+
+    def add_code_column(self, database):
+        '''Add and fill the packed code column of phrases in database'''
+        self.db.execute('ALTER TABLE %s.phrases ADD COLUMN code BLOB;'
+                        % database)
+        sqlstr = 'SELECT id, mlen, %s FROM %s.phrases;' % (
+            ', '.join(map(lambda x: 'm%d' % x, range(self._mlen))), database)
+        self.db.executemany(
+            'UPDATE %s.phrases SET code = ? WHERE id = ?;' % database,
+            map(lambda x: (self.pack_code(x[2:2+x[1]]), x[0]),
+                self.db.execute(sqlstr).fetchall()))
+        self.db.commit()
+
+    def pack_code(self, tabkey_ids):
+        '''Pack tabkey ids into the blob stored in code column'''
+        return sqlite3.Binary(''.join(map(chr, tabkey_ids)))
+
     def update_ime(self, attrs):
         '''Update attributes in ime table, attrs is a iterable object
         Like [(attr,val), (attr,val), ...]
@@ -344,6 +983,7 @@ class tabsqlitedb:
                 pass
         # then flush previous cache
         self.ime_property_cache = {}
+        self._sqlstrs = {}
         # we need to update some self variables now.
         self._mlen = int(self.get_ime_property('max_key_length'))
         self._is_chinese = self.is_chinese()
@@ -354,6 +994,7 @@ class tabsqlitedb:
         if self._is_chinese:
             self._pt_index += ['category']
         self._pt_index += ['phrase','freq','user_freq']
+        self._pt_columns = ', '.join(self._pt_index)
         self.user_can_define_phrase = self.get_ime_property(
             'user_can_define_phrase')
         if self.user_can_define_phrase:
@@ -440,14 +1081,105 @@ class tabsqlitedb:
             pass
         return _chars
 
-    def add_phrases(self, phrases, database = 'main'):
+    def add_phrases(self, phrases, database = 'main', pool=None, jobs=1):
         '''Add phrases to database, phrases is a iterable object
         Like: [(tabkeys, phrase, freq ,user_freq),
                (tabkeys, phrase, freq, user_freq),
                ...]
         '''
-        map(self.add_phrase, phrases, [database]*len(phrases), [False]*len(phrases))
-        self.db.commit()
+        self.bulk_add_phrases(phrases, database, pool=pool, jobs=jobs)
+
+    def bulk_add_phrases(self, phrases, database='main', commit=True,
+                         chunk_size=4096, pool=None, jobs=1):
+        '''Add phrases like add_phrases, with one executemany for every
+        chunk_size of them in one transaction, return how many phrases
+        we added. For chinese tables, the chunks are classified by the
+        multiprocessing pool of jobs workers if we have one, in order,
+        while we insert.
+        '''
+        if database == 'mudb':
+            map(lambda x: self.add_phrase(x, database, False), phrases)
+            if commit:
+                self.db.commit()
+            return len(phrases)
+        sqlstr = self._add_phrase_sqlstr % database
+        phrases = iter(phrases)
+        chunks = iter(lambda: list(itertools.islice(phrases, chunk_size)), [])
+        if pool and self._is_chinese:
+            # two chunks for every worker keeps all of them busy
+            chunks = classify_chunks(chunks, pool, 2 * jobs)
+        else:
+            chunks = itertools.imap(lambda x: (x, [None] * len(x)), chunks)
+        count = 0
+        for chunk, categories in chunks:
+            records = filter(None, map(self.tabkeys_record, chunk,
+                                       categories))
+            map(lambda x: x.append(self.pack_code(x[2:2+x[0]])), records)
+            if database == 'user_db':
+                last = self.db.execute(
+                    'SELECT max(id) FROM user_db.phrases;').fetchall()[0][0]
+            count += self.insert_records(sqlstr, records)
+            if database == 'user_db':
+                # the overlay needs the ids of the new rows
+                map(lambda x: self.overlay.add(database, x), self.db.execute(
+                    'SELECT %s FROM user_db.phrases WHERE id > ?;'
+                    % self._pt_columns, (last or 0,)))
+        if count:
+            self.candidate_cache.clear()
+        if commit:
+            self.db.commit()
+        return count
+
+    def insert_record(self, sqlstr, record):
+        '''Insert record with sqlstr, return the id of the new row, None
+        if we fail, which is reported'''
+        try:
+            return self.db.execute(sqlstr, record).lastrowid
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return None
+
+    def insert_records(self, sqlstr, records):
+        '''Insert records with one executemany, when a row fails the rest
+        are inserted one by one, so that only the bad rows are skipped,
+        return how many rows we inserted'''
+        changes = self.db.total_changes
+        try:
+            self.db.executemany(sqlstr, records)
+            return len(records)
+        except Exception:
+            # the rows before the bad one are in the transaction already
+            done = self.db.total_changes - changes
+            return done + len(filter(
+                lambda x: self.insert_record(sqlstr, x) is not None,
+                records[done:]))
+
+    def bulk_update_user_freq(self, rows, database='user_db', delta=False,
+                              commit=True):
+        '''Set the user_freq of rows in database to their last item, or
+        add it to the user_freq if delta is True. rows are in the form of
+        phrases rows, we run one executemany for each key length in one
+        transaction, return how many rows of database we updated.
+        '''
+        shape = 'merge_user_freq' if delta else 'update_phrase'
+        count = 0
+        for _mlen in set(map(lambda x: x[1], rows)):
+            cursor = self.db.executemany(
+                self.sqlstr(shape, database, _mlen),
+                map(lambda x: [x[-1]] + list(x[1:3+x[1]]) + [x[-3]],
+                    filter(lambda x: x[1] == _mlen, rows)))
+            count += cursor.rowcount
+        if database == 'user_db':
+            usrdb = self.overlay.rows(database)
+            map(lambda x: self.overlay.set_user_freq(
+                database, x[1:-2],
+                usrdb[x[1:-2]][-1] + x[-1] if delta else x[-1]),
+                filter(lambda x: x[1:-2] in usrdb, rows))
+        map(lambda x: self.candidate_cache.invalidate(x[3:3+x[1]]), rows)
+        if commit:
+            self.db.commit()
+        return count
 
     def add_new_phrases(self, nphrases, database='main'):
         '''Add new phrases into db, new phrases is a object
@@ -478,117 +1210,240 @@ class tabsqlitedb:
         if self._is_chinese:
             sqlstr += 'category, '
             sql_suffix += '?, '
-        sqlstr += 'phrase, freq, user_freq) '
-        sql_suffix += '?, ?, ? );'
+        sqlstr += 'phrase, freq, user_freq, code) '
+        sql_suffix += '?, ?, ?, ? );'
         sqlstr += sql_suffix
         self._add_phrase_sqlstr = sqlstr
 
-    def add_phrase(self, aphrase, database='main', commit=True):
-        '''Add phrase to database, phrase is a object of
-        (tabkeys, phrase, freq ,user_freq)
+    def sqlstr(self, shape, *args):
+        '''Return the sql statement of shape for args, built by
+        self._sqlstr_<shape>(*args) only once, so that the text of a
+        statement is the same every time and sqlite3 reuses it from its
+        statement cache
+        '''
+        key = (shape,) + args
+        try:
+            return self._sqlstrs[key]
+        except KeyError:
+            sqlstr = getattr(self, '_sqlstr_' + shape)(*args)
+            self._sqlstrs[key] = sqlstr
+            return sqlstr
+
+    def _sqlstr_condition(self, onechar, bitmask):
+        '''The onechar and bitmask condition of select_words'''
+        condition = ''
+        if onechar:
+            # for some users really like to select only single characters
+            condition += 'AND clen=1 '
+        if bitmask:
+            # now just the bits for chinese, the categories are 1 to 4,
+            # and this term matches the partial indexes of create_indexes
+            condition += 'AND category & %d ' % bitmask
+        return condition
+
+    def _sqlstr_keys(self, mlen):
+        '''The condition of the first mlen tabkeys'''
+        return ''.join(map(lambda x: 'AND m%d = ? ' % x, range(mlen)))
+
+    def _sqlstr_select_code(self, onechar, bitmask, complete):
+        condition = self._sqlstr_condition(onechar, bitmask)
+        if complete:
+            return '''SELECT %(cols)s FROM main.phrases
+            WHERE code >= ? AND code < ? %(condition)s
+            ORDER BY mlen ASC, user_freq DESC, freq DESC, id ASC;
+            ''' % {'cols':self._pt_columns, 'condition':condition}
+        # same as select_words_sql, we want the shortest completions
+        # and the ones with one key more
+        return '''SELECT %(cols)s FROM main.phrases
+            WHERE code >= ? AND code < ? %(condition)s
+            AND mlen <= (SELECT max(?, min(mlen)) FROM main.phrases
+                         WHERE code >= ? AND code < ? %(condition)s)
+            ORDER BY mlen ASC, user_freq DESC, freq DESC, id ASC;
+            ''' % {'cols':self._pt_columns, 'condition':condition}
+
+    def _sqlstr_select_sql(self, _len, mk, onechar, bitmask):
+        condition = (self._sqlstr_keys(_len)
+                     + self._sqlstr_condition(onechar, bitmask))
+        return '''SELECT %(cols)s FROM main.phrases
+            WHERE mlen < %(mk)d  %(condition)s
+            ORDER BY mlen ASC, user_freq DESC, freq DESC, id ASC;
+            ''' % {'cols':self._pt_columns, 'mk':mk, 'condition':condition}
+
+    def _sqlstr_select_top(self):
+        return '''SELECT %s FROM main.top_phrases AS t, main.phrases AS p
+        WHERE t.code = ? AND t.mask = ? AND p.id = t.id ORDER BY t.rank;
+        ''' % ', '.join(map(lambda x: 'p.%s' % x, self._pt_index))
+
+    def _sqlstr_check_phrase(self, mlen):
+        return '''SELECT %(cols)s FROM main.phrases WHERE phrase = ? %(cond)s;
+            ''' % {'cols':self._pt_columns, 'cond':self._sqlstr_keys(mlen)}
+
+    def _sqlstr_select_zi(self, _len, mk):
+        condition = ''.join(map(lambda x: 'AND p%d = ? ' % x, range(_len)))
+        return '''SELECT * FROM main.pinyin
+            WHERE plen < %(mk)d  %(condition)s
+            ORDER BY plen ASC, freq DESC;''' % {'mk':mk,
+                                                'condition':condition}
+
+    def _sqlstr_merge_user_freq(self, database, mlen):
+        return ('UPDATE %s.phrases SET user_freq = user_freq + ? '
+                'WHERE mlen = ? AND clen = ? '
+                '%s AND phrase = ?;') % (database, self._sqlstr_keys(mlen))
+
+    def _sqlstr_update_phrase(self, database, mlen):
+        return ('UPDATE %s.phrases SET user_freq = ? '
+                'WHERE mlen = ? AND clen = ? '
+                '%s AND phrase = ?;') % (database, self._sqlstr_keys(mlen))
+
+    def _sqlstr_phrase_condition(self, mlen):
+        '''The condition of a phrase row without id, freq and user_freq'''
+        if self._is_chinese:
+            return ('mlen = ? AND clen = ? %s AND category = ? '
+                    'AND phrase = ?') % self._sqlstr_keys(mlen)
+        return 'mlen = ? AND clen = ? %s AND phrase = ?' % self._sqlstr_keys(
+            mlen)
+
+    def _sqlstr_match_phrase(self, database, mlen):
+        return 'SELECT * FROM %s.phrases WHERE %s;' % (
+            database, self._sqlstr_phrase_condition(mlen))
+
+    def _sqlstr_add_sync_key(self):
+        columns = self._pt_index[1:-2]
+        return 'INSERT INTO temp.sync_keys (idx, %s) VALUES (?%s);' % (
+            ', '.join(columns), ', ?' * len(columns))
+
+    def _sqlstr_missing_keys(self, database, mlen):
+        columns = ['mlen', 'clen'] + map(lambda x: 'm%d' % x, range(mlen))
+        if self._is_chinese:
+            columns.append('category')
+        columns.append('phrase')
+        return ('SELECT idx FROM temp.sync_keys AS k WHERE k.mlen = %d '
+                'AND NOT EXISTS (SELECT 1 FROM %s.phrases AS p WHERE %s);'
+                ) % (mlen, database, ' AND '.join(
+                    map(lambda x: 'p.%s = k.%s' % (x, x), columns)))
+
+    def _sqlstr_has_phrase(self, database, mlen):
+        return ('SELECT 1 FROM %s.phrases WHERE mlen = %d %s '
+                'AND phrase = ? LIMIT 1;') % (database, mlen,
+                                               self._sqlstr_keys(mlen))
+
+    def _sqlstr_delete_phrase(self, database, mlen):
+        return 'DELETE FROM %s.phrases WHERE %s;' % (
+            database, self._sqlstr_phrase_condition(mlen))
+
+    def phrase_category(self, phrase):
+        '''Return the category bits of the unicode phrase'''
+        return phrase_category(phrase)
+
+    def phrase_record(self, tabkey_ids, phrase, freq, user_freq,
+                      category=None):
+        '''Return the row of phrase without id and code as a list, like
+        [mlen, clen, m0, ..., [category], phrase, freq, user_freq]
+        '''
+        record = [None] * (5 + self._mlen)
+        record [0] = len (tabkey_ids)
+        record [1] = len (phrase)
+        record [2: 2+len(tabkey_ids)] = tabkey_ids
+        if self._is_chinese:
+            record +=[None]
+            if category is None:
+                category = phrase_category(phrase)
+            record[-4] = category
+        record[-3:] = phrase, freq, user_freq
+        return record
+
+    def has_phrase(self, tabkeys, phrase, database='main'):
+        '''Whether database has phrase with tabkeys'''
+        tabkey_ids = map(int, self.parse(tabkeys))
+        return bool(self.db.execute(
+            self.sqlstr('has_phrase', database, len(tabkey_ids)),
+            tabkey_ids + [phrase]).fetchall())
+
+    def tabkeys_record(self, aphrase, category=None):
+        '''Return the row of aphrase, (tabkeys, phrase, freq[, user_freq]),
+        without id and code as a list, None if we can not parse tabkeys
         '''
-        sqlstr = self._add_phrase_sqlstr
         try:
             tabkeys, phrase, freq, user_freq = aphrase
         except:
             tabkeys, phrase, freq = aphrase
             user_freq = 0
-        # now we will set the category bits if this is chinese
-        if self._is_chinese:
-            # this is the bitmask we will use,
-            # from low to high, 1st bit is simplify Chinese,
-            # 2nd bit is traditional Chinese,
-            # 3rd bit means out of gbk
-            category = 0
-            # make sure that we got a unicode string
-            if type(phrase) != type(u''):
-                phrase = phrase.decode('utf8')
-            tmp_phrase = ''.join(re.findall(u'['
-                                            + u'\u4E00-\u9FCB'
-                                            + u'\u3400-\u4DB5'
-                                            + u'\uF900-\uFaFF'
-                                            + u'\U00020000-\U0002A6D6'
-                                            + u'\U0002A700-\U0002B734'
-                                            + u'\U0002B740-\U0002B81D'
-                                            + u'\U0002F800-\U0002FA1D'
-                                            + u']+',
-                                            phrase))
-            # first whether in gb2312
-            try:
-                tmp_phrase.encode('gb2312')
-                category |= 1
-            except:
-                if '〇'.decode('utf8') in tmp_phrase:
-                    # we add '〇' into SC as well
-                    category |= 1
-            # second check big5-hkscs
-            try:
-                tmp_phrase.encode('big5hkscs')
-                category |= 1 << 1
-            except:
-                # then check whether in gbk,
-                if category & 1:
-                    # already know in SC
-                    pass
-                else:
-                    # need to check
-                    try:
-                        tmp_phrase.encode('gbk')
-                        category |= 1
-                    except:
-                        # not in gbk
-                        pass
-            # then set for 3rd bit, if not in SC and TC
-            if not (category & (1 | 1 << 1)):
-                category |= (1 << 2)
+        if self._is_chinese and type(phrase) != type(u''):
+            phrase = phrase.decode('utf8')
+        tbks = self.parse(tabkeys)
+        tabkey_ids = map(lambda x: x.get_key_id(), tbks)
+        if (len(tbks) != len(tabkeys)
+                or filter(lambda x: not 0 <= x <= 255, tabkey_ids)):
+            print 'In %s %s: we parse tabkeys fail' % (phrase, tabkeys)
+            return None
+        return self.phrase_record(tabkey_ids, phrase, freq, user_freq,
+                                  category)
+
+    def add_phrase(self, aphrase, database='main', commit=True):
+        '''Add phrase to database, phrase is a object of
+        (tabkeys, phrase, freq ,user_freq)
+        '''
+        sqlstr = self._add_phrase_sqlstr
         try:
-            tbks = self.parse(tabkeys)
-            if len(tbks) != len(tabkeys):
-                print 'In %s %s: we parse tabkeys fail' % (phrase, tabkeys)
+            record = self.tabkeys_record(aphrase)
+            if not record:
                 return
-            record = [None] * (5 + self._mlen)
-            record [0] = len (tabkeys)
-            record [1] = len (phrase)
-            record [2: 2+len(tabkeys)] = map(lambda x: tbks[x].get_key_id(), range(0,len(tabkeys)))
-            if self._is_chinese:
-                record +=[None]
-                record[-4] = category
-            record[-3:] = phrase, freq, user_freq
-            self.db.execute(sqlstr % database, record)
+            tabkey_ids = record[2:2+record[0]]
+            if database == 'mudb':
+                # mudb lives in the overlay only
+                key = tuple(record[:-2])
+                self._mudb_dirty.add(key)
+                if key not in self._mudb_base:
+                    row = self.overlay.rows('user_db').get(key)
+                    self._mudb_base[key] = row[-1] if row else 0
+                self.journal_mudb(key, record[-2], record[-1], commit)
+                self.overlay.add(database, (self.overlay.next_id(database),)
+                                 + tuple(record))
+            else:
+                record.append(self.pack_code(tabkey_ids))
+                cursor = self.db.execute(sqlstr % database, record)
+                if database == 'user_db':
+                    self.overlay.add(database, (cursor.lastrowid,)
+                                     + tuple(record[:-1]))
+            self.candidate_cache.invalidate(tabkey_ids)
             if commit:
                 self.db.commit()
         except Exception:
             import traceback
             traceback.print_exc()
 
-    def add_goucima(self, gcms):
-        '''Add goucima into database, gcms is iterable object
-        Like gcms = [(zi,goucima),(zi,goucima), ...]
+    def goucima_records(self, gcms):
+        '''Yield the rows of main.goucima for gcms, like add_goucima,
+        the goucima we can not parse are reported and skipped
         '''
-        count = 1
         for zi,gcm in gcms:
-            _con = ''
-            _val = ''
             _len = min(len(gcm),self._mlen)
-            for i in range(_len):
-                _con += ', g%d' % i
-                _val += ', ?'
-            sqlstr = ('INSERT INTO main.goucima (zi %s)'
-                      ' VALUES (? %s);') % (_con, _val)
             try:
                 gc = self.parse(gcm)
                 if len(gc) != len(gcm):
                     error_m = u'%s %s: Can not parse goucima' % (zi, gcm)
                     raise Exception(error_m.encode('utf8'))
-                record = [zi]
+                record = [None] * (1 + self._mlen)
+                record[0] = zi
                 for i in range(_len):
-                    record.append(gc[i].get_key_id())
-                self.db.execute(sqlstr , record)
+                    record[1+i] = gc[i].get_key_id()
+                yield record
+            except Exception:
+                import traceback
+                traceback.print_exc()
 
+    def add_goucima(self, gcms):
+        '''Add goucima into database, gcms is iterable object
+        Like gcms = [(zi,goucima),(zi,goucima), ...]
+        '''
+        sqlstr = 'INSERT INTO main.goucima VALUES (%s);' % ', '.join(
+            ['?'] * (1 + self._mlen))
+        for record in self.goucima_records(gcms):
+            try:
+                self.db.execute(sqlstr , record)
             except Exception:
                 import traceback
                 traceback.print_exc()
-            count += 1
         self.db.commit()
 
     def add_pinyin(self, pinyins, database = 'main'):
@@ -604,6 +1459,13 @@ class tabsqlitedb:
         sql_suffix += '?, ? );'
         sqlstr += sql_suffix
 
+        self.db.executemany(sqlstr % database, self.pinyin_records(pinyins))
+        self.db.commit()
+
+    def pinyin_records(self, pinyins):
+        '''Yield the rows of the pinyin table for pinyins, like
+        add_pinyin, the pinyin we can not parse are reported and skipped
+        '''
         count = 1
         for pinyin, zi, freq in pinyins:
             try:
@@ -624,14 +1486,52 @@ class tabsqlitedb:
                     record[1+i] = py[i].get_key_id()
                 record[-2] = zi
                 record[-1] = freq
-                self.db.execute(sqlstr % database, record)
+                yield record
             except Exception:
                 print count, ': ', zi.encode('utf8'), ' ', pinyin
                 import traceback
                 traceback.print_exc()
             count += 1
 
+    def replace_rows(self, table, records, database='main'):
+        '''Replace the rows of table in database with records, a list of
+        whole rows, unless it has the same rows in this order already.
+        Return whether we replaced them.
+        '''
+        rows = self.db.execute('SELECT * FROM %s.%s ORDER BY rowid;'
+                               % (database, table)).fetchall()
+        if (map(lambda x: map(unicode, x), rows)
+                == map(lambda x: map(unicode, x), records)):
+            return False
+        self.db.execute('DELETE FROM %s.%s;' % (database, table))
+        if records:
+            self.db.executemany('INSERT INTO %s.%s VALUES (%s);' % (
+                database, table, ', '.join(['?'] * len(records[0]))), records)
+        self.db.commit()
+        return True
+
+    def phrase_keys(self, database='main'):
+        '''Return a cursor of (id, code, phrase, freq) of the rows of
+        phrases in database, ordered by code, phrase and id'''
+        return self.db.execute('SELECT id, code, phrase, freq FROM %s.phrases '
+                               'ORDER BY code, phrase, id;' % database)
+
+    def apply_phrase_changes(self, inserts, freqs, deletes, database='main',
+                             pool=None, jobs=1):
+        '''Delete the rows whose id is in deletes, set the freq of the
+        rows in freqs, a list of (freq, id), and add inserts like
+        bulk_add_phrases, in one transaction. Return how many phrases we
+        added.
+        '''
+        self.db.executemany('DELETE FROM %s.phrases WHERE id = ?;' % database,
+                            map(lambda x: (x,), deletes))
+        self.db.executemany('UPDATE %s.phrases SET freq = ? WHERE id = ?;'
+                            % database, freqs)
+        count = self.bulk_add_phrases(inserts, database, commit=False,
+                                      pool=pool, jobs=jobs)
+        self.candidate_cache.clear()
         self.db.commit()
+        return count
 
     def optimize_database(self, database='main'):
         sqlstr = '''
@@ -666,12 +1566,23 @@ class tabsqlitedb:
             DROP INDEX IF EXISTS %(database)s.pinyin_index_i;
             DROP INDEX IF EXISTS %(database)s.phrases_index_p;
             DROP INDEX IF EXISTS %(database)s.phrases_index_i;
+            DROP INDEX IF EXISTS %(database)s.phrases_index_c;
+            DROP INDEX IF EXISTS %(database)s.phrases_index_s;
+            DROP INDEX IF EXISTS %(database)s.phrases_index_t;
             VACUUM;
             ''' % {'database':database}
 
         self.db.executescript(sqlstr)
         self.db.commit()
 
+    def create_lookup_index(self, database, commit=True):
+        '''Create only the index of create_indexes which has_phrase
+        uses, for adding phrases to a database built without indexes'''
+        self.db.execute('CREATE INDEX IF NOT EXISTS %s.phrases_index_i '
+                        'ON phrases (phrase, mlen ASC);' % database)
+        if commit:
+            self.db.commit()
+
     def create_indexes(self, database, commit=True):
         sqlstr = '''
             CREATE INDEX IF NOT EXISTS
@@ -687,6 +1598,20 @@ class tabsqlitedb:
             CREATE INDEX IF NOT EXISTS %(database)s.phrases_index_i ON phrases
                 (phrase, mlen ASC);
             '''
+        if self.has_code_column(database):
+            sqlstr_t += '''
+            CREATE INDEX IF NOT EXISTS %(database)s.phrases_index_c ON phrases
+                (code, mlen ASC);
+            '''
+            if self._is_chinese and sqlite3.sqlite_version_info >= (3, 8, 0):
+                # partial indexes for SC and TC mode, sqlite uses them
+                # for the "category & 1" and "category & 2" terms
+                sqlstr_t += '''
+            CREATE INDEX IF NOT EXISTS %(database)s.phrases_index_s ON phrases
+                (code, mlen ASC) WHERE category & 1;
+            CREATE INDEX IF NOT EXISTS %(database)s.phrases_index_t ON phrases
+                (code, mlen ASC) WHERE category & 2;
+            '''
         tabkeystr = ''
         for i in range(self._mlen):
             tabkeystr +='m%d,' % i
@@ -703,29 +1628,155 @@ class tabsqlitedb:
         return (cmp(x[1], y[1]) or -(cmp(x[-1], y[-1]))
                 or -(cmp (x[-2], y[-2])) or (cmp (x[0], y[0])))
 
-    def select_words(self, tabkeys, onechar=False, bitmask=0):
+    def candidate_key(self, x):
+        '''Sort key of candidates, same order as compare'''
+        return (x[1], -x[-1], -x[-2], x[0])
+
+    def select_words(self, tabkeys, onechar=False, bitmask=0, limit=None):
         '''
         Get phrases from database by tab_key objects
         ( which should be equal or less than the max key length)
         This method is called in table.py by passing UserInput held data
-        Return result[:]
+        Return result[:], or only the first limit phrases of it if limit
+        is given.
+        '''
+        if limit is None:
+            return self.select_prefix(tabkeys, onechar, bitmask).candidates[:]
+        _len = min(len(tabkeys),self._mlen)
+        _tabkeys = map(int,tabkeys[:_len])
+        res = self.candidate_cache.get(_tabkeys, onechar, bitmask)
+        if res:
+            return res.candidates[:limit]
+        # we stop merging once we have limit phrases, so we can not
+        # cache this result
+        rows = self.merge_candidates(
+            self.select_rows(_tabkeys, onechar, bitmask)[0])
+        first = next(rows, None)
+        if first is None or limit < 1:
+            return []
+        # same as prefix_result, rows are sorted by mlen
+        bound = max(_len + 1, first[1])
+        return [first] + list(itertools.islice(
+            itertools.takewhile(lambda x: x[1] <= bound, rows), limit - 1))
+
+    def select_prefix(self, tabkeys, onechar=False, bitmask=0, parent=None):
+        '''
+        Get phrases from database by tab_key objects like select_words,
+        but return a prefix_result. If parent is a complete prefix_result
+        of a prefix of tabkeys, the result is narrowed down from it
+        without sql enquiry.
         '''
         # firstly, we make sure the len we used is equal or
         # less than the max key length
         _len = min(len(tabkeys),self._mlen)
-        _condition = ''
-        _condition += ''.join(map(lambda x: 'AND m%d = ? ' %x, range(_len)))
-        if onechar:
-            # for some users really like to select only single characters
-            _condition += 'AND clen=1 '
-        if bitmask:
-            # now just the bits for chinese
-            all_ints = xrange(1,5)
-            need_ints = filter(lambda x: x & bitmask, all_ints)
-            bit_condition = 'OR'.join(map(lambda x: ' category = %d ' %x,\
-                    need_ints))
-            _condition += 'AND (%s) ' % bit_condition
-
+        # we have redefine the __int__(self) in class tabdict.tab_key to
+        # return the key id, so we can use map to got key id :)
+        _tabkeys = map(int,tabkeys[:_len])
+        res = self.candidate_cache.get(_tabkeys, onechar, bitmask)
+        if res:
+            return res
+        if (parent and parent.complete
+                and parent.matches(_tabkeys, onechar, bitmask)):
+            res = parent.narrow(_tabkeys)
+            self.candidate_cache.put(res)
+            return res
+        result, complete = self.select_rows(_tabkeys, onechar, bitmask)
+        res = prefix_result(_tabkeys, onechar, bitmask,
+                            list(self.merge_candidates(result)), complete)
+        self.candidate_cache.put(res)
+        return res
+
+    def select_rows(self, tabkey_ids, onechar=False, bitmask=0):
+        '''Get the rows of main, user_db and mudb for tabkey_ids, return
+        (rows, complete), see prefix_result for complete
+        '''
+        _len = len(tabkey_ids)
+        # we select all completions when the prefix is long enough, so
+        # that the following keys can be narrowed down from this result
+        complete = _len >= self.complete_prefix_len
+        if (_len <= self._top_prefix_len and not onechar
+                and bitmask in self.top_phrases_masks()):
+            # only the first candidates of short prefixes are stored
+            return self.select_words_top(tabkey_ids, bitmask), False
+        if self._prefix_index or self._phrase_image:
+            return self.select_words_indexed(tabkey_ids, onechar, bitmask,
+                                             complete), complete
+        if self._main_has_code:
+            return self.select_words_code(tabkey_ids, onechar, bitmask,
+                                          complete), complete
+        return self.select_words_sql(tabkey_ids, onechar, bitmask,
+                                     complete), complete
+
+    def merge_candidates(self, result):
+        '''Merge the rows of main, user_db and mudb into candidates,
+        sorted like compare, as a generator. A phrase learned in mudb
+        shadows the same phrase of user_db, which shadows the system one.
+        '''
+        # rows with user_freq come from user_db and mudb, they are few,
+        # so we collect them first to know which system rows to drop
+        usrdb = {}
+        mudb = {}
+        for res in result:
+            if not res[-1]:
+                continue
+            if res[-2] in (0, -1):
+                usrdb[res[1:-2]] = res
+            else:
+                mudb[res[1:-2]] = res
+        seen = set(mudb)
+        seen.update(usrdb)
+
+        def _system():
+            # the last duplicate of a system phrase wins, as it always did
+            for res in reversed(result):
+                if not res[-1]:
+                    key = res[1:-2]
+                    if key not in seen:
+                        seen.add(key)
+                        yield res
+
+        def _stream(i, rows):
+            # sql enquiries already give the rows in this order, then
+            # sorted() is linear on them
+            return sorted(itertools.imap(
+                lambda x: (self.candidate_key(x), i, x), rows))
+
+        merged = heapq.merge(
+            _stream(0, mudb.itervalues()),
+            _stream(1, itertools.ifilter(lambda x: x[1:-2] not in mudb,
+                                         usrdb.itervalues())),
+            _stream(2, _system()))
+        return itertools.imap(lambda x: x[-1], merged)
+
+    def select_words_code(self, tabkey_ids, onechar=False, bitmask=0,
+                          complete=False):
+        '''Get the rows matching tabkey_ids from main, user_db and mudb
+        with one range scan on the packed code column, shortest
+        completions first, or all completions if complete is True
+        '''
+        _len = len(tabkey_ids)
+        code_range = [self.pack_code(tabkey_ids),
+                      self.pack_code(tabkey_ids[:-1] + [tabkey_ids[-1] + 1])]
+        sqlstr = self.sqlstr('select_code', onechar, bitmask, complete)
+        if complete:
+            sys_rows = self.db.execute(sqlstr, code_range).fetchall()
+        else:
+            sys_rows = self.db.execute(sqlstr, code_range + [_len + 1]
+                                       + code_range).fetchall()
+        bound = self._mlen
+        if sys_rows and not complete:
+            bound = max(_len + 1, sys_rows[0][1])
+        return self.select_words_overlay(tabkey_ids, onechar, bitmask,
+                                         sys_rows, bound, complete)
+
+    def select_words_sql(self, tabkey_ids, onechar=False, bitmask=0,
+                         complete=False):
+        '''Get the rows matching tabkey_ids from main, user_db and mudb
+        by sql enquiry, shortest completions first, or all completions
+        if complete is True. This is used for databases without the
+        packed code column.
+        '''
+        _len = len(tabkey_ids)
         # you can increase the x in _len + x to include more result,
         # but in the most case, we only need one more key result,
         # so we don't need the extra overhead :)
@@ -735,72 +1786,195 @@ class tabsqlitedb:
         # we start from 2, because it is < in the sqlite select,
         # which need 1 more.
         x_len = 2
+        if complete:
+            x_len = w_len + 1
+        result = []
+        bound = self._mlen
         while x_len <= w_len + 1:
-            sqlstr = '''SELECT * FROM (SELECT * FROM main.phrases
-            WHERE mlen < %(mk)d  %(condition)s
-            UNION ALL
-            SELECT * FROM user_db.phrases WHERE mlen < %(mk)d %(condition)s
-            UNION ALL
-            SELECT * FROM mudb.phrases WHERE mlen < %(mk)d %(condition)s )
-            ORDER BY mlen ASC, user_freq DESC, freq DESC, id ASC;
-            ''' % {'mk':_len+x_len, 'condition':_condition}
-            # we have redefine the __int__(self) in class tabdict.tab_key to
-            # return the key id, so we can use map to got key id :)
-            _tabkeys = map(int,tabkeys[:_len])
-            _tabkeys += _tabkeys + _tabkeys
-            result = self.db.execute(sqlstr, _tabkeys).fetchall()
+            sqlstr = self.sqlstr('select_sql', _len, _len + x_len,
+                                 onechar, bitmask)
+            result = self.db.execute(sqlstr, tabkey_ids).fetchall()
             #self.db.commit()
             # if we find word, we stop this while,
             if len(result) >0:
+                bound = min(bound, _len + x_len - 1)
                 break
             x_len += 1
-        # here in order to get high speed, I use complicated map
-        # to subtitute for
-        sysdb = {}
-        usrdb = {}
-        mudb = {}
-        _cand = []
-        #searchres = map(lambda res: res[-2] and
-        #        [True, [(res[:-2],[res[:-1],res[-1:]])]]\
-        #        or [ False, [(res[:-2] , [res[:-1],res[-1:]])] ] \
-        #        , result )
-        searchres = map(lambda res: [int(res[-2]), int(res[-1]),
-            [(res[1:-2], [res[:-1], res[-1:]])]], result)
-        # for sysdb
-        reslist = filter(lambda x: not x[1], searchres)
-        map(lambda x: sysdb.update(x[2]), reslist)
-        # for usrdb
-        reslist = filter(lambda x: (x[0] in [0,-1]) and x[1], searchres)
-        map(lambda x: usrdb.update(x[2]), reslist)
-        # for mudb
-        reslist = filter(lambda x: ( x[0] not in [0,-1]) and x[1], searchres)
-        map(lambda x: mudb.update(x[2]), reslist)
+        return self.select_words_overlay(tabkey_ids, onechar, bitmask,
+                                         result, bound, complete)
 
-        # first process mudb
-        searchres = map(lambda key: mudb[key][0] + mudb[key][1], mudb)
-        #print searchres
-        map(_cand.append, searchres)
-
-        # now process usrdb and sysdb
-        searchres = map(lambda key: (not mudb.has_key(key)) and usrdb[key][0]
-                        + usrdb[key][1] or None, usrdb)
-        searchres = filter(lambda x: bool(x), searchres)
-        #print searchres
-        map(_cand.append, searchres)
-        searchres = map(lambda key: ((not mudb.has_key(key)) and (not usrdb.has_key(key))) and sysdb[key][0] + sysdb[key][1]\
-                or None, sysdb )
-        searchres = filter(lambda x: bool(x), searchres)
-        map(_cand.append, searchres)
-        #for key in usrdb:
-        #    if not sysdb.has_key (key):
-        #        _cand.append( usrdb[key][0] + usrdb[key][1] )
-        #    else:
-        #        _cand.append( sysdb[key][0] + usrdb[key][1] )
-        #for key in sysdb:
-        #    if not usrdb.has_key (key):
-        #        _cand.append( sysdb[key][0] + sysdb[key][1] )
-        _cand.sort(cmp=self.compare)
-        return _cand[:]
+    def open_phrase_image(self, name):
+        '''Open the mmaped image of main.phrases written by
+        ibus-table-createdb, return None if there is no usable one
+        '''
+        _image = tabmmap.image_name(name)
+        if not path.exists(_image):
+            return None
+        try:
+            image = tabmmap.tabmmap(_image)
+        except:
+            import traceback
+            traceback.print_exc()
+            return None
+        if (image._mlen != self._mlen or '%d' % image.checksum !=
+                self.get_ime_property('binary_checksum')):
+            print >> stderr, 'Phrase image %s is outdated, ignore it.' % _image
+            image.close()
+            return None
+        return image
+
+    def write_phrase_image(self, name):
+        '''Write the mmaped image of main.phrases for database name'''
+        checksum = tabmmap.write_image(self, tabmmap.image_name(name))
+        self.set_ime_property('binary_checksum', '%d' % checksum)
+
+    def build_prefix_index(self):
+        '''Load main.phrases into memory, one array of rows per key
+        length sorted by tabkey ids, so that select_words can find all
+        completions of a prefix with bisect instead of sql enquiries
+        '''
+        index = {}
+        sqlstr = ('SELECT %s FROM main.phrases ORDER BY mlen ASC, %s'
+                  'user_freq DESC, freq DESC, id ASC;') % (
+                      self._pt_columns,
+                      ''.join(map(lambda x: 'm%d, ' % x, range(self._mlen))))
+        for row in self.db.execute(sqlstr):
+            _mlen = row[1]
+            if _mlen not in index:
+                index[_mlen] = ([], [])
+            index[_mlen][0].append(row[3:3+_mlen])
+            index[_mlen][1].append(row)
+        self._prefix_index = index
+
+    def select_words_indexed(self, tabkey_ids, onechar=False, bitmask=0,
+                             complete=False):
+        '''Get the rows matching tabkey_ids like select_words_sql, but
+        take main.phrases from the in memory prefix index or the mmaped
+        phrase image, so that we only need one sql enquiry for the user_db
+        and mudb overlays
+        '''
+        _len = len(tabkey_ids)
+        prefix = tuple(tabkey_ids)
+        upper = prefix[:-1] + (prefix[-1] + 1,)
+        cat = self._pt_index.index('category') if bitmask else 0
+        sys_rows = []
+        # the longest key length we need to include, it is fixed by
+        # the shortest completion we find, same as select_words_sql
+        bound = self._mlen
+        found = complete
+        for _mlen in xrange(_len, self._mlen + 1):
+            if found and _mlen > bound:
+                break
+            if self._phrase_image:
+                _rows = self._phrase_image.select(_mlen, tabkey_ids)
+            elif _mlen in self._prefix_index:
+                keys, rows = self._prefix_index[_mlen]
+                _rows = rows[bisect_left(keys, prefix):
+                             bisect_left(keys, upper)]
+            else:
+                continue
+            if onechar:
+                _rows = filter(lambda x: x[2] == 1, _rows)
+            if bitmask:
+                _rows = filter(lambda x: x[cat] & bitmask, _rows)
+            if _rows and not found:
+                found = True
+                bound = max(_len + 1, _mlen)
+            sys_rows += _rows
+        return self.select_words_overlay(tabkey_ids, onechar, bitmask,
+                                         sys_rows, bound, complete)
+
+    def select_words_overlay(self, tabkey_ids, onechar, bitmask, sys_rows,
+                             bound, complete=False):
+        '''Add the rows of user_db and mudb matching tabkey_ids to
+        sys_rows, which are the rows of main.phrases with mlen <= bound,
+        and drop the rows longer than the shortest completions
+        '''
+        _len = len(tabkey_ids)
+        usr_rows = self.overlay.select(
+            tabkey_ids, bound, onechar, bitmask,
+            self._is_chinese and self._pt_index.index('category'))
+        if usr_rows and not complete:
+            bound = min(bound, max(_len + 1, min(map(lambda x: x[1],
+                                                     usr_rows))))
+        return filter(lambda x: x[1] <= bound, sys_rows + usr_rows)
+
+    def build_top_phrases(self, top_n, prefix_len):
+        '''Store the first top_n candidates of main.phrases for every
+        prefix up to prefix_len keys into main.top_phrases, in the order
+        select_words shows them, for each category bitmask the engine
+        may filter with. Short prefixes are then answered from this
+        table instead of selecting all their completions.
+        '''
+        prefix_len = min(prefix_len, self._mlen)
+        self.db.executescript('''
+            DROP TABLE IF EXISTS main.top_phrases;
+            CREATE TABLE main.top_phrases
+                (code BLOB, mask INTEGER, rank INTEGER, id INTEGER);
+            ''')
+        masks = self.top_phrases_masks()
+        cat = self._is_chinese and self._pt_index.index('category')
+        sqlstr = ('SELECT %s FROM main.phrases '
+                  'ORDER BY mlen ASC, user_freq DESC, freq DESC, id ASC;'
+                  % self._pt_columns)
+        rows = self.db.execute(sqlstr).fetchall()
+        for _len in xrange(1, prefix_len + 1):
+            # (prefix, mask) -> [bound, ids]
+            tops = {}
+            for row in rows:
+                if row[1] < _len:
+                    continue
+                prefix = row[3:3+_len]
+                for mask in masks:
+                    if mask and not row[cat] & mask:
+                        continue
+                    top = tops.get((prefix, mask))
+                    if top is None:
+                        # rows are sorted by mlen, so this is one of the
+                        # shortest completions
+                        top = tops[(prefix, mask)] = [
+                            max(_len + 1, row[1]), []]
+                    if row[1] <= top[0] and len(top[1]) < top_n:
+                        top[1].append(row[0])
+            self.db.executemany(
+                'INSERT INTO main.top_phrases (code, mask, rank, id) '
+                'VALUES (?,?,?,?);',
+                ((self.pack_code(prefix), mask, rank, _id)
+                 for (prefix, mask), (bound, ids) in sorted(tops.iteritems())
+                 for rank, _id in enumerate(ids)))
+        self.db.execute('CREATE INDEX main.top_phrases_index_c '
+                        'ON top_phrases (code, mask, rank);')
+        self.set_ime_property('top_phrases', '%d' % top_n)
+        self.set_ime_property('top_prefix_len', '%d' % prefix_len)
+
+    def drop_top_phrases(self):
+        '''Drop main.top_phrases, all prefixes are selected from
+        main.phrases then'''
+        self.db.execute('DROP TABLE IF EXISTS main.top_phrases;')
+        for attr in ('top_phrases', 'top_prefix_len'):
+            if self.get_ime_property(attr):
+                self.set_ime_property(attr, '0')
+        self.db.commit()
+
+    def top_phrases_masks(self):
+        '''Return the category bitmasks main.top_phrases is built for'''
+        if self._is_chinese:
+            return [0, 1, 2]
+        return [0]
+
+    def select_words_top(self, tabkey_ids, bitmask):
+        '''Get the first candidates of a short prefix from
+        main.top_phrases, and merge in the user_db and mudb rows of it
+        '''
+        _len = len(tabkey_ids)
+        sys_rows = self.db.execute(
+            self.sqlstr('select_top'),
+            (self.pack_code(tabkey_ids), bitmask)).fetchall()
+        bound = self._mlen
+        if sys_rows:
+            bound = max(_len + 1, sys_rows[0][1])
+        return self.select_words_overlay(tabkey_ids, False, bitmask,
+                                         sys_rows, bound)
 
     def select_zi(self, tabkeys):
         '''
@@ -812,10 +1986,6 @@ class tabsqlitedb:
         # firstly, we make sure the len we used is equal or less than
         # the max pinyin length 7 (include tune[1-5])
         _len = min(len(tabkeys), 7)
-        _condition = ''
-        #for i in range(_len):
-        #    _condition += 'AND p%d = ? ' % i
-        _condition += ''.join ( map (lambda x: 'AND p%d = ? ' %x, range(_len)) )
         # you can increase the x in _len + x to include more result,
         # but in the most case, we only need one more key result, so
         # we don't need the extra overhead :) here we need make sure
@@ -831,10 +2001,7 @@ class tabsqlitedb:
             x_len = _len
 
         while x_len <= 8:
-            sqlstr = '''SELECT * FROM main.pinyin
-            WHERE plen < %(mk)d  %(condition)s
-            ORDER BY plen ASC, freq DESC;''' % {'mk':x_len,
-                                                'condition':_condition}
+            sqlstr = self.sqlstr('select_zi', _len, x_len)
             # we have redefine the __int__(self) in class
             # tabdict.tab_key to return the key id, so we can use map
             # to got key id :)
@@ -859,6 +2026,14 @@ class tabsqlitedb:
                 self.ime_property_cache[attr] = None
         return self.ime_property_cache[attr]
 
+    def set_ime_property(self, attr, val):
+        '''set IME property in database, add it if it is not there'''
+        self.db.execute('DELETE FROM main.ime WHERE attr = ?;', (attr,))
+        self.db.execute('INSERT INTO main.ime (attr,val) VALUES (?,?);',
+                        (attr, val))
+        self.db.commit()
+        self.ime_property_cache[attr] = val
+
     def get_phrase_table_index(self):
         '''get a list of phrase table columns name'''
         return self._pt_index[:]
@@ -878,6 +2053,20 @@ class tabsqlitedb:
             import traceback
             traceback.print_exc()
 
+    def get_userdb_desc(self, name):
+        '''Get the value of name in user_db.desc'''
+        res = self.db.execute('SELECT value FROM user_db.desc WHERE name = ?;',
+                              (name,)).fetchall()
+        if res:
+            return res[0][0]
+        return None
+
+    def set_userdb_desc(self, name, value):
+        '''Set the value of name in user_db.desc'''
+        self.db.execute('INSERT OR REPLACE INTO user_db.desc VALUES (?, ?);',
+                        (name, value))
+        self.db.commit()
+
     def init_user_db(self,db_file):
         if not path.exists (db_file):
             db = sqlite3.connect (db_file)
@@ -992,19 +2181,41 @@ class tabsqlitedb:
             tabkeys= u''
         return tabkeys
 
-    def check_phrase(self,phrase,tabkey=None,database='main'):
+    def check_phrase(self,phrase,tabkey=None,database='main',commit=True):
         # if IME didn't support user define phrase,
         # we divide user input phrase into characters,
         # and then check its frequence
         if type(phrase) != type(u''):
             phrase = phrase.decode('utf8')
         if self.user_can_define_phrase:
-            self.check_phrase_internal(phrase, tabkey, database)
+            self.check_phrase_internal(phrase, tabkey, database, commit)
         else:
-            map(self.check_phrase_internal, phrase)
-
-    def check_phrase_internal(self,phrase,tabkey=None,database='main'):
-        '''Check word freq and user_freq
+            map(lambda x: self.check_phrase_internal(x, commit=commit),
+                phrase)
+
+    def queue_phrase(self, phrase, tabkey=None, database='main'):
+        '''Queue a committed phrase for check_phrase, the queued
+        phrases are learned together by learn_phrases'''
+        self._learn_queue.append((phrase, tabkey, database))
+
+    def learn_phrases(self):
+        '''check_phrase the queued phrases in one transaction,
+        return how many phrases we learned'''
+        queue = self._learn_queue
+        self._learn_queue = []
+        for phrase, tabkey, database in queue:
+            self.check_phrase(phrase, tabkey, database, commit=False)
+        if queue:
+            self.db.commit()
+            if self.journal:
+                # one fsync for the batch
+                self.journal.flush()
+        return len(queue)
+
+    def check_phrase_internal(self,phrase,tabkey=None,database='main',
+                              commit=True):
+        '''Check word freq and user_freq, commit the changes to mudb
+        if commit is True
         '''
         if type(phrase) != type(u''):
             phrase = phrase.decode('utf8')
@@ -1019,43 +2230,16 @@ class tabsqlitedb:
                 # if we don't have goucima:
                 return
         if (not tabkey) or len(tabkey) > self._mlen :
-            sqlstr = '''
-            SELECT * FROM (SELECT * FROM main.phrases WHERE phrase = ?
-            UNION ALL SELECT * FROM user_db.phrases WHERE phrase = ?
-            UNION ALL SELECT * FROM mudb.phrases WHERE phrase = ?)
-            ORDER BY user_freq DESC, freq DESC, id ASC;
-            '''
-            result = self.db.execute(sqlstr, (phrase,phrase,phrase)).fetchall()
+            result = self.select_phrase_rows(phrase)
         else:
             # we are using this to check whether the tab-key and phrase is in db
             #print "tabkey: ", tabkey
             tabks = self.parse(tabkey)
             #print "tabks: ", tabks
             tabkids = tuple(map(int,tabks))
-            condition = ' and '.join(
-                map(lambda x: 'm%d = ?' % x, range(len(tabks)))
-            )
-            sqlstr = '''SELECT * FROM
-            (
-                SELECT * FROM main.phrases WHERE phrase = ? and %(cond)s
-                UNION ALL SELECT * FROM user_db.phrases
-                    WHERE phrase = ? and %(cond)s
-                UNION ALL SELECT * FROM mudb.phrases
-                    WHERE phrase = ? and %(cond)s
-            )
-            ORDER BY user_freq DESC, freq DESC, id ASC;
-            ''' % {'cond':condition}
-            #print sqlstr
-            result = self.db.execute(sqlstr, ((phrase,)+tabkids)*3).fetchall()
+            result = self.select_phrase_rows(phrase, tabkids)
             if not bool(result):
-                sqlstr = '''
-                SELECT * FROM (SELECT * FROM main.phrases WHERE phrase = ?
-                UNION ALL SELECT * FROM user_db.phrases WHERE phrase = ?
-                UNION ALL SELECT * FROM mudb.phrases WHERE phrase = ?)
-                ORDER BY user_freq DESC, freq DESC, id ASC;
-                '''
-                result = self.db.execute(sqlstr,
-                                         (phrase,phrase,phrase)).fetchall()
+                result = self.select_phrase_rows(phrase)
 
         sysdb = {}
         usrdb = {}
@@ -1082,14 +2266,6 @@ class tabsqlitedb:
             #for k in wordattr[2:2+_len]:
             #    tabkey += self.deparse (k)
 
-        if self._is_chinese:
-            sqlstr = ('UPDATE mudb.phrases SET user_freq = ? '
-                      'WHERE mlen = ? AND clen = ? %s AND category = ? '
-                      'AND phrase = ?;')
-        else:
-            sqlstr = ('UPDATE mudb.phrases SET user_freq = ? '
-                      'WHERE mlen = ? AND clen = ? %s AND phrase = ?;')
-
         try:
             if len(phrase) == 1:
                 # this is a character
@@ -1103,10 +2279,12 @@ class tabsqlitedb:
                 keyout = filter(lambda k: mudb.has_key(k) or usrdb.has_key(k), sysdb.keys())
                 map (sysdb.pop, keyout)
                 # first mudb
-                map (lambda res: self.db.execute(sqlstr % ''.join(
-                    map(lambda x: 'AND m%d = ? ' % x, range(res[0]))), [mudb[res][1] + 1] + list(res[:2+res[0]]) + list(res[2+self._mlen:])), mudb.keys()
+                map (lambda res: self.set_mudb_user_freq(
+                    res, mudb[res][1] + 1, commit), mudb.keys()
                 )
-                self.db.commit()
+                map(lambda res: self.candidate_cache.invalidate(
+                    res[2:2+res[0]]), mudb.keys())
+                self._mudb_dirty.update(mudb.keys())
                 # -----original for loop of above map:
                 #for res in mudb.keys ():
                 #    _con = [mudb[res][1] + 1] + list(res[:2+res[0]])\
@@ -1117,7 +2295,7 @@ class tabsqlitedb:
                 #    self.db.execute ( sqlstr % _condition, _con )
 
                 # then usrdb
-                map(lambda res: self.add_phrase((''.join(map(self.deparse,res[2:2+int(res[0])])),phrase,1,usrdb[res][1]+1), database = 'mudb'), usrdb.keys())
+                map(lambda res: self.add_phrase((''.join(map(self.deparse,res[2:2+int(res[0])])),phrase,1,usrdb[res][1]+1), database='mudb', commit=commit), usrdb.keys())
                 # -----original for loop of above map:
                 #for res in usrdb.keys ():
                 #    #if mudb.has_key (res):
@@ -1127,7 +2305,7 @@ class tabsqlitedb:
                 #    # needed update in user_db
                 #    self.add_phrase((tabkey, phrase, 1, usrdb[res][1]+1 ), database='mudb')
                 # last sysdb
-                map(lambda res: self.add_phrase((''.join(map(self.deparse, res[2:2+int(res[0])])), phrase, 2, 1), database='mudb'), sysdb.keys())
+                map(lambda res: self.add_phrase((''.join(map(self.deparse, res[2:2+int(res[0])])), phrase, 2, 1), database='mudb', commit=commit), sysdb.keys())
                 # -----original for loop of above map:
                 #for res in sysdb.keys ():
                 #    tabkey = ''.join ( map(self.deparse,res[2:2+int(res[0])]) )
@@ -1138,7 +2316,7 @@ class tabsqlitedb:
                 # this is a phrase
                 if len(result) == 0 and self.user_can_define_phrase:
                     # this is a new phrase, we add it into user_db
-                    self.add_phrase((tabkey,phrase,-2,1), database='mudb')
+                    self.add_phrase((tabkey,phrase,-2,1), database='mudb', commit=commit)
                 elif len(result) > 0:
                     if not self.dynamic_adjust:
                         # we should change the frequency of words
@@ -1152,12 +2330,15 @@ class tabsqlitedb:
 
                     # first we process mudb
                     # the original for loop can be found above in 'len==1'
-                    map(lambda res: self.db.execute(sqlstr % ''.join( map(lambda x: 'AND m%d = ? ' % x, range(res[0]))), [mudb[res][1] + 1] + list(res[:2+res[0]]) + list(res[2+self._mlen:])), mudb.keys())
-                    self.db.commit()
+                    map(lambda res: self.set_mudb_user_freq(
+                        res, mudb[res][1] + 1, commit), mudb.keys())
+                    map(lambda res: self.candidate_cache.invalidate(
+                        res[2:2+res[0]]), mudb.keys())
+                    self._mudb_dirty.update(mudb.keys())
                     # then usrdb
-                    map(lambda res: self.add_phrase((''.join(map(self.deparse,res[2:2+int(res[0])])), phrase, (-3 if usrdb[res][0][-1] == -1 else 1), usrdb[res][1]+1), database='mudb'), usrdb.keys())
+                    map(lambda res: self.add_phrase((''.join(map(self.deparse,res[2:2+int(res[0])])), phrase, (-3 if usrdb[res][0][-1] == -1 else 1), usrdb[res][1]+1), database='mudb', commit=commit), usrdb.keys())
                     # last sysdb
-                    map(lambda res: self.add_phrase((''.join(map(self.deparse,res[2:2+int(res[0])])), phrase, 2, 1), database='mudb'), sysdb.keys())
+                    map(lambda res: self.add_phrase((''.join(map(self.deparse,res[2:2+int(res[0])])), phrase, 2, 1), database='mudb', commit=commit), sysdb.keys())
 
                 else:
                     # we come to here when the ime dosen't support
@@ -1169,13 +2350,24 @@ class tabsqlitedb:
             import traceback
             traceback.print_exc()
 
+    def select_phrase_rows(self, phrase, tabkey_ids=()):
+        '''Return the rows of phrase from main.phrases and the overlay,
+        whose keys start with tabkey_ids, sorted by user_freq DESC,
+        freq DESC, id ASC'''
+        _len = len(tabkey_ids)
+        result = self.db.execute(self.sqlstr('check_phrase', _len),
+                                 (phrase,) + tuple(tabkey_ids)).fetchall()
+        result += self.overlay.select_phrase(phrase, tabkey_ids)
+        result.sort(key=lambda x: (-x[-1], -x[-2], x[0]))
+        return result
+
     def find_zi_code(self,zi):
         '''Check word freq and user_freq
         '''
         zi = zi.decode('utf8')
-        sqlstr = '''SELECT * FROM main.phrases WHERE phrase = ?
+        sqlstr = '''SELECT %s FROM main.phrases WHERE phrase = ?
         ORDER BY mlen ASC;
-        '''
+        ''' % self._pt_columns
         result = self.db.execute(sqlstr, (zi, )).fetchall()
         #self.db.commit()
         codes = []
@@ -1196,57 +2388,120 @@ class tabsqlitedb:
         phrase should be the a row of select * result from database
         Like (id, mlen,clen,m0,m1,m2,m3,phrase,freq,user_freq)
         '''
+        # the queued phrases must not add it back after we removed it
+        self.learn_phrases()
         _ph = list(phrase[:-2])
-        _condition = ''
-        for i in range(_ph[1]):
-            _condition += 'AND m%d = ? ' % i
+        self.candidate_cache.invalidate(phrase[3:3+phrase[1]])
+        # we delete it from both user_db and mudb, nothing left to sync
+        if self.journal and tuple(phrase[1:-2]) in self.overlay.rows('mudb'):
+            self.journal.append(0, phrase[3:3+phrase[1]],
+                                phrase[-4] if self._is_chinese else 0,
+                                phrase[-3], 0)
+            self.journal.flush()
+        self._mudb_dirty.discard(tuple(phrase[1:-2]))
+        self._mudb_base.pop(tuple(phrase[1:-2]), None)
         nn =_ph.count(None)
         if nn:
             for i in range(nn):
                 _ph.remove(None)
-        if self._is_chinese:
-            msqlstr= ('SELECT * FROM %(database)s.phrases '
-                      'WHERE mlen = ? and clen = ? %(condition)s '
-                      'AND category = ? AND phrase = ? ;'
-            ) % {'database':database, 'condition':_condition}
-        else:
-            msqlstr= ('SELECT * FROM %(database)s.phrases '
-                      'WHERE mlen = ? and clen = ? %(condition)s '
-                      'AND phrase = ? ;'
-            ) % {'database':database, 'condition':_condition}
-        if self.db.execute(msqlstr, _ph[1:]).fetchall():
-            if self._is_chinese:
-                sqlstr = ('DELETE FROM %(database)s.phrases '
-                          'WHERE mlen = ? AND clen =? %(condition)s '
-                          'AND category = ? AND phrase = ?;'
-                ) % { 'database':database, 'condition':_condition}
-            else:
-                sqlstr = ('DELETE FROM %(database)s.phrases '
-                          'WHERE mlen = ? AND clen =? %(condition)s '
-                          'AND phrase = ?  ;'
-                ) % {'database':database, 'condition':_condition}
-            self.db.execute(sqlstr, _ph[1:])
-            self.db.commit()
-
-        if self._is_chinese:
-            msqlstr= ('SELECT * FROM mudb.phrases WHERE mlen = ? '
-                      'AND clen = ? %(condition)s AND category = ? '
-                      'AND phrase = ? ;') % { 'condition':_condition }
+        if database != 'mudb':
+            msqlstr = self.sqlstr('match_phrase', database, phrase[1])
+            if self.db.execute(msqlstr, _ph[1:]).fetchall():
+                sqlstr = self.sqlstr('delete_phrase', database, phrase[1])
+                self.db.execute(sqlstr, _ph[1:])
+                self.db.commit()
+        for _db in ('user_db', 'mudb'):
+            if _db in (database, 'mudb'):
+                self.overlay.remove(_db, tuple(phrase[1:-2]))
+
+    def rename_outdated_user_db(self, user_db, desc):
+        '''Rename user_db away if we can not use it, desc is its
+        get_database_desc, return the new name, None if it is fine'''
+        if desc["version"] != "0.5":
+            new_name = "%s.%d" % (user_db, os.getpid())
+            print >> stderr, ' '.join(
+                ['Can not support the user db.',
+                 'We will rename it to %s' % new_name]
+            )
+        elif self.get_table_phrase_len(user_db) not in (
+                len(self._pt_index), len(self._pt_index) + 1):
+            print >> stderr, "user db format outdated."
+            new_name = "%s.%d" % (user_db, os.getpid())
         else:
-            msqlstr= ('SELECT * FROM mudb.phrases WHERE mlen = ? '
-                      'AND clen = ? %(condition)s AND phrase = ? ;'
-            ) % { 'condition':_condition }
-        if self.db.execute(msqlstr, _ph[1:]).fetchall():
-            if self._is_chinese:
-                sqlstr = ('DELETE FROM mudb.phrases WHERE mlen = ? '
-                          'AND clen =? %(condition)s AND category = ? '
-                          'AND phrase = ?;') % {'condition':_condition}
-            else:
-                sqlstr = ('DELETE FROM mudb.phrases WHERE mlen = ? '
-                          'AND clen =? %(condition)s AND phrase = ?;'
-                ) % {'condition':_condition}
-            self.db.execute(sqlstr,_ph[1:])
+            return None
+        os.rename(user_db, new_name)
+        return new_name
+
+    def upgrade_user_db(self, user_db):
+        '''Migrate the user database file user_db now if it is outdated,
+        as the engine would when it opens it, return how many phrases we
+        copied. We neither create user_db nor touch its journals, and
+        this db must be opened without user_db.
+        '''
+        desc = self.get_database_desc(user_db)
+        if desc == None:
+            return 0
+        old_db = self.rename_outdated_user_db(user_db, desc)
+        if old_db:
+            self.init_user_db(user_db)
+        self.db.commit()
+        self.db.execute('DETACH DATABASE user_db;')
+        self.db.execute('ATTACH DATABASE "%s" AS user_db;' % user_db)
+        self.create_tables('user_db')
+        if not self.has_code_column('user_db'):
+            self.add_code_column('user_db')
+        copied = 0
+        if old_db:
+            copied = self.migrate_user_db(old_db)
+        self.create_indexes('user_db')
+        return copied
+
+    def migrate_user_db(self, old_db, chunk_size=1000):
+        '''Copy the phrases of the outdated user database old_db into
+        user_db, chunk_size phrases per transaction, return how many
+        phrases we copied. Their codes are derived again from goucima,
+        single characters and phrases we can not parse are dropped.
+        '''
+        try:
+            db = sqlite3.connect(old_db)
+            total = db.execute('SELECT count(*) FROM (SELECT clen FROM phrases '
+                               'WHERE mlen != 0 AND clen > 1 '
+                               'GROUP BY clen, phrase);').fetchall()[0][0]
+            cursor = db.execute('SELECT clen, phrase, freq, sum(user_freq) '
+                                'FROM phrases WHERE mlen != 0 AND clen > 1 '
+                                'GROUP BY clen, phrase;')
+        except:
+            import traceback
+            traceback.print_exc()
+            return 0
+        cached = bool(self._goucima)
+        if not cached:
+            try:
+                self.cache_goucima()
+            except:
+                pass
+        sqlstr = self._add_phrase_sqlstr % 'user_db'
+        done = copied = 0
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            records = []
+            for clen, phrase, freq, user_freq in rows:
+                res = self.parse_phrase(phrase)
+                if res and None not in res[2:-1]:
+                    record = self.phrase_record(res[2:-1], res[-1], freq,
+                                                user_freq)
+                    records.append(record + [self.pack_code(res[2:-1])])
+            self.db.executemany(sqlstr, records)
             self.db.commit()
+            done += len(rows)
+            copied += len(records)
+            print >> stderr, 'migrating %s: %d/%d' % (old_db, done, total)
+        db.close()
+        if not cached:
+            self._goucima = {}
+        return copied
 
     def extra_user_phrases(self, udb, only_defined=False):
         '''extract user phrases from database'''